@@ -0,0 +1,455 @@
+"""
+Benchmarks for the hot paths of the MCA and market-variability code, run offline against a synthetic system.
+
+The synthetic technosphere is built to resemble ecoinvent (about 15,000 processes at scale 1): a few hundred "hub"
+processes (electricity, transport, heat...) that supply one another in cycles and supply every other process, and a
+couple of inputs per process from elsewhere in the supply chain.  The biosphere has about 4,000 flows.  No
+brightway2 project or lca-tools catalog is needed; the package and its dependencies must be importable.
+
+Timed:
+ - mca_update: Bw2McaSimple._update_results (sample, _MatrixRefill rebuild, solve, score, sketch and write), per
+   sample, with the container's RunMetrics phase breakdown for the last repeat
+ - weighted_next, weighted_sample, stratified_sample: supplier choice, per draw
+ - add_scores_spsolve, add_scores_factorize: MarketImpactRangeResult.add_scores with a BackgroundLcia, per market;
+   lu_factorize: the one-time factorization behind the latter
+ - store_save, store_load: McaResultStore append + commit and load; json_save, json_load: export_json and reading
+   it back
+ - find_95, is_outlier, mc_stats, mc_histogram, sketch_update, sketch_interval: the mca_charts statistics
+
+Results are written as JSON: for each benchmark, the time of every repeat, the best, and the best per item.
+
+usage: python benchmarks/run_benchmarks.py [--scale 0.1] [--output bench.json] [--only mca_update,find_95]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+
+import numpy as np
+import scipy
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lcatools import from_json  # noqa: E402
+
+from bw2calc.utils import TYPE_DICTIONARY  # noqa: E402
+
+from lca_variability.bw2_mca import Bw2McaContainer, Bw2McaSimple  # noqa: E402
+from lca_variability.bw2_mkt_weight import WeightedChooser, StratifiedChooser  # noqa: E402
+from lca_variability.background import BackgroundLcia  # noqa: E402
+from lca_variability.lca_variability import MarketImpactRangeResult  # noqa: E402
+from lca_variability.mca_results import McaResultStore, ScoreSketch  # noqa: E402
+from lca_variability.mca_charts import find_95, is_outlier, McStats, McHistogram  # noqa: E402
+
+
+class SyntheticSystem(object):
+    """
+    A random technosphere matrix A and biosphere matrix B.  Each column of A sums to 0.6, so I - A is nonsingular.
+    """
+    def __init__(self, n_tech=15000, n_bio=4000, inputs=8, local=2, hubs=300, emissions=25, seed=0):
+        """
+
+        :param n_tech: number of processes
+        :param n_bio: number of emissions
+        :param inputs: [8] technosphere inputs per process
+        :param local: [2] of which this many come from anywhere upstream; the rest come from hubs
+        :param hubs: [300] number of hub processes
+        :param emissions: [25] emissions per process
+        :param seed:
+        """
+        rng = np.random.default_rng(seed)
+        self.n_tech = n_tech
+        self.n_bio = n_bio
+        hubs = max(1, min(hubs, n_tech // 5))
+        cols = np.repeat(np.arange(n_tech), inputs)
+        r_hub = rng.integers(0, hubs, (n_tech, inputs - local))
+        r_loc = (rng.random((n_tech, local)) * np.arange(n_tech)[:, None]).astype(int)
+        rows = np.concatenate([r_hub, r_loc], axis=1).ravel()
+        ok = rows != cols
+        a = sparse.csc_matrix((rng.random(len(rows))[ok], (rows[ok], cols[ok])), shape=(n_tech, n_tech))
+        a.sum_duplicates()
+        s = np.asarray(a.sum(axis=0)).ravel()
+        s[s == 0] = 1.0
+        self.A = (a @ sparse.diags(0.6 / s)).tocsc()
+
+        b_cols = np.repeat(np.arange(n_tech), emissions)
+        b_rows = rng.integers(0, n_bio, len(b_cols))
+        self.B = sparse.csc_matrix((rng.lognormal(0, 2, len(b_cols)), (b_rows, b_cols)), shape=(n_bio, n_tech))
+        self.B.sum_duplicates()
+
+        self._tech = (sparse.eye(n_tech, format='csc') - self.A).tocsc()
+        self._tech.sort_indices()
+        self.demand = np.zeros(n_tech)
+        self.demand[n_tech - 1] = 1.0
+
+
+class _SyntheticActivity(dict):
+    @property
+    def key(self):
+        return self['database'], self['activity']
+
+
+class _LognormalGenerator(object):
+    """
+    Stands in for a stats_arrays MCRandomNumberGenerator: each next() is the base amounts with lognormal noise on the
+    uncertain ones
+    """
+    def __init__(self, amounts, uncertain, seed=None, sigma=0.1):
+        self._amounts = amounts
+        self._uncertain = uncertain
+        self._sigma = sigma
+        self._rng = np.random.default_rng(seed)
+
+    def next(self):
+        noise = self._rng.lognormal(0, self._sigma, len(self._amounts))
+        return np.where(self._uncertain, self._amounts * noise, self._amounts)
+
+
+class _SyntheticMonteCarlo(object):
+    """
+    The parts of bw2calc's MonteCarloLCA that Bw2McaSimple uses, over a SyntheticSystem: parameter arrays in the
+    brightway2 layout (technosphere inputs as positive amounts, flipped by fix_supply_use), generators created by
+    load_data(), and a direct sparse solve
+    """
+    def __init__(self, system, seed=None):
+        self._sys = system
+        self.seed = seed
+
+    def load_lci_data(self):
+        s = self._sys
+        dtype = [('row', np.int32), ('col', np.int32), ('type', np.uint8), ('amount', np.float64)]
+        a = s.A.tocoo()
+        n = s.n_tech
+        self.tech_params = np.zeros(n + a.nnz, dtype=dtype)
+        self.tech_params['row'] = np.concatenate([np.arange(n), a.row])
+        self.tech_params['col'] = np.concatenate([np.arange(n), a.col])
+        self.tech_params['type'] = np.concatenate([np.full(n, TYPE_DICTIONARY['production']),
+                                                   np.full(a.nnz, TYPE_DICTIONARY['technosphere'])])
+        self.tech_params['amount'] = np.concatenate([np.ones(n), a.data])
+        b = s.B.tocoo()
+        self.bio_params = np.zeros(b.nnz, dtype=dtype)
+        self.bio_params['row'] = b.row
+        self.bio_params['col'] = b.col
+        self.bio_params['type'] = TYPE_DICTIONARY['biosphere']
+        self.bio_params['amount'] = b.data
+        self.technosphere_matrix = s._tech.tocsr()
+        self.biosphere_matrix = s.B.tocsr()
+        self._biosphere_dict = {i: i for i in range(s.n_bio)}
+
+    def load_data(self):
+        self.load_lci_data()
+        self.tech_rng = _LognormalGenerator(self.tech_params['amount'],
+                                            self.tech_params['type'] != TYPE_DICTIONARY['production'], seed=self.seed)
+        self.bio_rng = _LognormalGenerator(self.bio_params['amount'], np.ones(len(self.bio_params), dtype=bool),
+                                           seed=self.seed)
+
+    def build_demand_array(self):
+        self.demand_array = self._sys.demand
+
+    def solve_linear_system(self):
+        return spsolve(self.technosphere_matrix, self.demand_array)
+
+
+class SyntheticMca(Bw2McaSimple):
+    """
+    Bw2McaSimple on a SyntheticSystem: every draw goes through Bw2McaSimple._next_emissions-- parameter sampling,
+    the _MatrixRefill rebuild of both matrices, the solve and the reduction to emissions-- just as with the brightway2
+    model.  Methods are random characterization vectors.
+    """
+    FILE_PREFIX = 'BW2_bench'
+
+    def __init__(self, system, *args, seed=None, **kwargs):
+        self._sys = system
+        self._sol = _SyntheticMonteCarlo(system, seed=seed)
+        self._sol.load_lci_data()
+        self._biosphere_dict = self._sol._biosphere_dict
+        self._tech_fill = None
+        self._bio_fill = None
+        act = _SyntheticActivity(database='synthetic', activity='synthetic-%d' % system.n_tech)
+        Bw2McaContainer.__init__(self, act, *args, seed=seed, **kwargs)  # Bw2McaSimple's would build a MonteCarloLCA
+
+    def _c_matrix(self, method):
+        rng = np.random.default_rng([ord(c) for c in ''.join(method)])
+        cf = np.where(rng.random(self._sys.n_bio) < 0.3, rng.lognormal(0, 3, self._sys.n_bio), 0.0)
+        return sparse.diags(cf, format='csr')
+
+
+class _FlatBackground(object):
+    """
+    Enough of an lca-tools flat background for BackgroundLcia: every process is in the background, and process
+    'p<i>' is column i
+    """
+    def __init__(self, system):
+        self._A = system.A
+        self._B = system.B
+        self.ndim = system.n_tech
+        self.ex = [SimpleNamespace(flow_ref='f%d' % i) for i in range(system.n_bio)]
+        self._af = sparse.csr_matrix((0, 0))
+        self._ad = sparse.csr_matrix((system.n_tech, 0))
+        self._bf = sparse.csr_matrix((system.n_bio, 0))
+
+    @staticmethod
+    def index_of(process_ref, flow_ref):
+        return int(process_ref[1:])
+
+    @staticmethod
+    def is_in_background(process_ref, flow_ref):
+        return True
+
+
+class _Quantity(object):
+    def __init__(self, external_ref, n_bio, rng):
+        self.external_ref = external_ref
+        cf = np.where(rng.random(n_bio) < 0.3, rng.lognormal(0, 3, n_bio), 0.0)
+        self._cfs = {'f%d' % i: v for i, v in enumerate(cf) if v != 0}
+
+    def cf(self, flow):
+        return self._cfs.get(flow.external_ref, 0.0)
+
+
+def _market(ref, suppliers, rng):
+    flow = SimpleNamespace(external_ref='mkt_flow')
+    exchs = [SimpleNamespace(flow=flow, termination=s, value=v) for s, v in zip(suppliers, rng.random(len(suppliers)))]
+    return SimpleNamespace(external_ref=ref, reference=lambda: SimpleNamespace(flow=flow),
+                           inventory=lambda flow_ref: exchs)
+
+
+def _bench(run, setup=None, repeat=3, items=1):
+    """
+    :param run: function of the value returned by setup
+    :param setup: [None] called before each repeat, untimed
+    :param repeat: [3]
+    :param items: [1] number of items processed per run, for the per-item time
+    :return: dict
+    """
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        t = time.perf_counter()
+        run(arg)
+        times.append(time.perf_counter() - t)
+    return {'seconds': times, 'best': min(times), 'items': items, 'per_item': min(times) / items}
+
+
+class BenchmarkSuite(object):
+    def __init__(self, scale=1.0, samples=20, markets=10, suppliers=10, methods=4, repeat=3, seed=0):
+        self.params = {'scale': scale, 'samples': samples, 'markets': markets, 'suppliers': suppliers,
+                       'methods': methods, 'repeat': repeat, 'seed': seed}
+        self._repeat = repeat
+        self._samples = samples
+        self._markets = markets
+        self._suppliers = suppliers
+        self._methods = [('synthetic', 'method %d' % i) for i in range(methods)]
+        self._seed = seed
+        self._rng = np.random.default_rng(seed)
+        self._tmp = tempfile.mkdtemp(prefix='lca_var_bench_')
+        t = time.perf_counter()
+        self.system = SyntheticSystem(n_tech=max(100, int(15000 * scale)), n_bio=max(20, int(4000 * scale)),
+                                      seed=seed)
+        self.params['build_seconds'] = time.perf_counter() - t
+        self.params['n_tech'] = self.system.n_tech
+        self.params['n_bio'] = self.system.n_bio
+        self.params['tech_nnz'] = int(self.system.A.nnz)
+        self._scores = np.random.default_rng(seed).lognormal(0, 1, 100000)
+
+    def _folder(self, name):
+        return tempfile.mkdtemp(prefix=name + '_', dir=self._tmp)
+
+    def bench_mca_update(self):
+        containers = []
+
+        def setup():
+            containers.append(SyntheticMca(self.system, *self._methods, seed=self._seed, folder=self._folder('mca'),
+                                           steps=0))
+            return containers[-1]
+
+        def run(c):
+            c.steps = self._samples
+        res = _bench(run, setup, repeat=self._repeat, items=self._samples)
+        res['phases'] = containers[-1].metrics.summary()['phases']  # breakdown of the last repeat
+        return res
+
+    def bench_weighted_next(self):
+        n = 10000
+        ch = WeightedChooser(self._rng.random(50), seed=self._seed)
+        return _bench(lambda _: [next(ch) for _ in range(n)], repeat=self._repeat, items=n)
+
+    def bench_weighted_sample(self):
+        n = 1000000
+        ch = WeightedChooser(self._rng.random(50), seed=self._seed)
+        return _bench(lambda _: ch.sample(n), repeat=self._repeat, items=n)
+
+    def bench_stratified_sample(self):
+        n = 10000
+        return _bench(lambda ch: ch.sample(n), lambda: StratifiedChooser(self._rng.random(50)), repeat=self._repeat,
+                      items=n)
+
+    def _background(self):
+        s = self.system
+        rng = np.random.default_rng(self._seed)
+        qs = [_Quantity('q%d' % i, s.n_bio, rng) for i in range(len(self._methods))]
+        query = SimpleNamespace(get=lambda ref: SimpleNamespace(external_ref=ref), origin='synthetic')
+        bg = BackgroundLcia(SimpleNamespace(_flat=_FlatBackground(s)), query, *qs)
+        _ = bg.characterization
+        mkts = [_market('p%d' % m, ['p%d' % x for x in rng.integers(0, s.n_tech, self._suppliers)], rng)
+                for m in rng.integers(0, s.n_tech, self._markets)]
+        return bg, qs, mkts
+
+    def _add_scores(self, bg, qs, mkts, **kwargs):
+        for m in mkts:
+            MarketImpactRangeResult(m, *qs).add_scores(bg, **kwargs)
+
+    def bench_add_scores_spsolve(self):
+        bg, qs, mkts = self._background()
+        return _bench(lambda _: self._add_scores(bg, qs, mkts), repeat=self._repeat, items=len(mkts))
+
+    def bench_lu_factorize(self):
+        bg, _, _ = self._background()
+        return _bench(lambda _: bg._factorize(), repeat=self._repeat)
+
+    def bench_add_scores_factorize(self):
+        bg, qs, mkts = self._background()
+        bg.lci_vector('p0', 'mkt_flow', solver='factorize')  # factorization is timed in lu_factorize
+        return _bench(lambda _: self._add_scores(bg, qs, mkts, solver='factorize'), repeat=self._repeat,
+                      items=len(mkts))
+
+    def _fill_store(self, store):
+        n = len(self._scores) // len(self._methods)
+        for i, m in enumerate(self._methods):
+            store.append('__'.join(m), self._scores[i * n:(i + 1) * n])
+        store.commit('synthetic', n, {'__'.join(m): list(m) for m in self._methods})
+
+    def bench_store_save(self):
+        return _bench(self._fill_store, lambda: McaResultStore(os.path.join(self._folder('store'), 'bench.mca')),
+                      repeat=self._repeat, items=len(self._scores))
+
+    def bench_store_load(self):
+        store = McaResultStore(os.path.join(self._folder('store'), 'bench.mca'))
+        self._fill_store(store)
+
+        def run(_):
+            s = McaResultStore(store.path)
+            for k in s.keys:
+                s.load(k, mmap=False)
+        return _bench(run, repeat=self._repeat, items=len(self._scores))
+
+    def _json_container(self):
+        c = SyntheticMca(self.system, seed=self._seed, folder=self._folder('json'), steps=0)
+        for i, m in enumerate(self._methods):
+            c._m_map['__'.join(m)] = m
+            c._res.add_key('__'.join(m))
+            c._res.extend('__'.join(m), self._scores[i::len(self._methods)])
+        return c
+
+    def bench_json_save(self):
+        c = self._json_container()
+        fn = os.path.join(self._tmp, 'bench.json.gz')
+        return _bench(lambda _: c.export_json(fn), repeat=self._repeat, items=len(self._scores))
+
+    def bench_json_load(self):
+        fn = os.path.join(self._tmp, 'bench.json.gz')
+        self._json_container().export_json(fn)
+        return _bench(lambda _: from_json(fn), repeat=self._repeat, items=len(self._scores))
+
+    def bench_find_95(self):
+        return _bench(lambda _: find_95(self._scores), repeat=self._repeat, items=len(self._scores))
+
+    def bench_is_outlier(self):
+        return _bench(lambda _: is_outlier(self._scores, thresh=6), repeat=self._repeat, items=len(self._scores))
+
+    def bench_mc_stats(self):
+        return _bench(lambda _: McStats(self._scores).interval_95, repeat=self._repeat, items=len(self._scores))
+
+    def bench_mc_histogram(self):
+        return _bench(lambda _: McHistogram(self._scores, log_correct=True), repeat=self._repeat,
+                      items=len(self._scores))
+
+    def bench_sketch_update(self):
+        return _bench(lambda _: ScoreSketch(self._scores), repeat=self._repeat, items=len(self._scores))
+
+    def bench_sketch_interval(self):
+        sk = ScoreSketch(self._scores)
+        return _bench(lambda _: sk.interval_95(), repeat=self._repeat)
+
+    @property
+    def names(self):
+        return [k[6:] for k in sorted(dir(self)) if k.startswith('bench_')]
+
+    def run(self, only=None):
+        results = dict()
+        for name in self.names:
+            if only and name not in only:
+                continue
+            print('Running %s' % name, file=sys.stderr)
+            with redirect_stdout(sys.stderr):
+                results[name] = getattr(self, 'bench_' + name)()
+            print('  best %.6g sec, %.6g sec per item' % (results[name]['best'], results[name]['per_item']),
+                  file=sys.stderr)
+        return results
+
+    def cleanup(self):
+        shutil.rmtree(self._tmp, ignore_errors=True)
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the MCA and market-variability hot paths')
+    parser.add_argument('--scale', type=float, default=1.0, help='size of the synthetic system (1.0: ecoinvent-like)')
+    parser.add_argument('--samples', type=int, default=20, help='Monte Carlo samples per mca_update run')
+    parser.add_argument('--markets', type=int, default=10, help='markets per add_scores run')
+    parser.add_argument('--suppliers', type=int, default=10, help='suppliers per market')
+    parser.add_argument('--methods', type=int, default=4, help='LCIA methods / quantities')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', default=None, help='comma-separated benchmark names')
+    parser.add_argument('--output', default=None, help='JSON output file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    suite = BenchmarkSuite(scale=args.scale, samples=args.samples, markets=args.markets, suppliers=args.suppliers,
+                           methods=args.methods, repeat=args.repeat, seed=args.seed)
+    try:
+        only = set(args.only.split(',')) if args.only else None
+        unknown = (only or set()) - set(suite.names)
+        if unknown:
+            parser.error('unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+        results = suite.run(only=only)
+    finally:
+        suite.cleanup()
+
+    out = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'revision': _git_revision(),
+           'python': platform.python_version(),
+           'platform': platform.platform(),
+           'numpy': np.__version__,
+           'scipy': scipy.__version__,
+           'params': suite.params,
+           'results': results}
+    if args.output is None:
+        json.dump(out, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as fp:
+            json.dump(out, fp, indent=2)
+        print('Written to %s' % args.output, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,7 @@
 from .lca_variability import MarketImpactRangeResult, MarketIterator
+from .background import BackgroundLcia
+from .market_index import MarketIndex
+from .lci_cache import LciCache
+from .metrics import RunMetrics
 from .bw2_mca import initialize_activity, Bw2McaSimple
 from .bw2_mkt_weight import initialize_market_model, Bw2McaMarketWeight
@@ -0,0 +1,327 @@
+"""
+Matrix-level LCIA against an lca-tools flat background.
+
+bg.lci() returns an inventory as a list of exchange objects, and quantity.do_lcia() then looks up characterization
+factors for them one flow at a time.  Once the background is factorized, that bookkeeping costs more than the solve.
+BackgroundLcia instead keeps the LCI as a vector over the background's emission index, and applies every quantity
+at once through a sparse (quantities x emissions) characterization matrix that is built the first time it is needed.
+
+Several LCIs can also be computed together (lci_matrix): the demand vectors are stacked into one multi-column
+right-hand side and solved against the LU factors of the background (I - A) in a single call, so a market and all of
+its suppliers cost one triangular solve rather than one round trip each.
+
+The LU factors can be kept in a cache directory (lu_cache), keyed by the background's origin and a checksum of its
+(I - A) matrix.  They are stored as raw arrays and memory-mapped when loaded, so a new session or process can solve
+straight away instead of paying for the factorization again.
+
+The flat background is partitioned as in lca-tools: foreground processes (fg) with their own technology matrix _af,
+dependencies _ad on the background and direct emissions _bf; background processes (bg, ndim of them) with technology
+matrix _A and emissions _B.
+"""
+
+import os
+import re
+import hashlib
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import splu, spsolve, spsolve_triangular
+
+from .metrics import RunMetrics
+
+
+class LuFactors(object):
+    """
+    The LU factorization of a sparse matrix M, as computed by SuperLU: Pr * M * Pc = L * U, where L has a unit
+    diagonal.  The factors can be saved as raw arrays and memory-mapped back in.  A factorization computed in this
+    session solves with SuperLU; one that was loaded from disk solves with two sparse triangular solves.
+    """
+    _parts = ('L_data', 'L_indices', 'L_indptr', 'U_data', 'U_indices', 'U_indptr', 'perm_r', 'perm_c')
+
+    @classmethod
+    def factorize(cls, matrix):
+        lu = splu(sparse.csc_matrix(matrix))
+        return cls(lu.L.tocsr(), lu.U.tocsr(), lu.perm_r, lu.perm_c, superlu=lu)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: a directory written by save()
+        :return:
+        """
+        a = {k: np.load(os.path.join(path, k + '.npy'), mmap_mode='r') for k in cls._parts}
+        n = len(a['perm_r'])
+        l_mat = sparse.csr_matrix((a['L_data'], a['L_indices'], a['L_indptr']), shape=(n, n), copy=False)
+        u_mat = sparse.csr_matrix((a['U_data'], a['U_indices'], a['U_indptr']), shape=(n, n), copy=False)
+        return cls(l_mat, u_mat, a['perm_r'], a['perm_c'])
+
+    def __init__(self, l_mat, u_mat, perm_r, perm_c, superlu=None):
+        self._L = l_mat
+        self._U = u_mat
+        self._perm_r = perm_r
+        self._perm_c = perm_c
+        self._superlu = superlu
+
+    def save(self, path):
+        """
+        Write the factors to a directory, one .npy file per array.  The directory is written under a temporary name
+        and renamed into place, so an interrupted save leaves nothing behind to be loaded.
+        :param path:
+        :return:
+        """
+        tmp = path + '.tmp'
+        os.makedirs(tmp, exist_ok=True)
+        arrays = {'L_data': self._L.data, 'L_indices': self._L.indices, 'L_indptr': self._L.indptr,
+                  'U_data': self._U.data, 'U_indices': self._U.indices, 'U_indptr': self._U.indptr,
+                  'perm_r': self._perm_r, 'perm_c': self._perm_c}
+        for k, v in arrays.items():
+            np.save(os.path.join(tmp, k + '.npy'), np.asarray(v))
+        os.replace(tmp, path)
+
+    def solve(self, y):
+        """
+        Solve M x = y
+        :param y: dense array, 1 or 2 dimensional
+        :return:
+        """
+        if self._superlu is not None:
+            return self._superlu.solve(y)
+        z = np.empty_like(y, dtype=float)
+        z[self._perm_r] = y
+        z = spsolve_triangular(self._L, z, lower=True, unit_diagonal=True)
+        z = spsolve_triangular(self._U, z, lower=False)
+        return z[self._perm_c]
+
+
+def matrix_checksum(matrix):
+    """
+    :param matrix: a sparse matrix
+    :return: sha1 hex digest of the matrix's structure and values in canonical CSC form
+    """
+    m = sparse.csc_matrix(matrix)
+    m.sum_duplicates()
+    m.sort_indices()
+    h = hashlib.sha1()
+    h.update(np.asarray(m.shape, dtype=np.int64).tobytes())
+    for arr, dtype in ((m.indptr, np.int64), (m.indices, np.int64), (m.data, np.float64)):
+        h.update(np.ascontiguousarray(arr, dtype=dtype).tobytes())
+    return h.hexdigest()
+
+
+class BackgroundLcia(object):
+    """
+    Computes LCIA scores for several quantities directly from the matrices of a flat background.
+    """
+    def __init__(self, archive, query, *quantities, lu_cache=None, lci_cache=None, metrics=None):
+        """
+
+        :param archive: the background archive, e.g. catalog.get_archive(origin, 'background'), whose _flat
+         attribute is the flat background
+        :param query: a catalog query that can retrieve the background's emission flows
+        :param quantities: quantity refs, supporting cf(flow)
+        :param lu_cache: [None] directory in which to keep the LU factors of the background, e.g. alongside the
+         catalog.  If None, the factors are computed in every session.
+        :param lci_cache: [None] an LciCache in which to keep computed LCI vectors, so that a process is only solved
+         once while its LCI stays cached, e.g. when another quantity is added or scores are reset
+        :param metrics: [None] a RunMetrics to record the 'factorize', 'solve' and 'characterize' phases and count
+         'lcis_solved', and to deliver messages about the LU cache
+        """
+        self._metrics = RunMetrics() if metrics is None else metrics
+        self._flat = archive._flat
+        self._query = query
+        self._lu_cache = lu_cache
+        self._lci_cache = lci_cache
+        self._quantities = quantities
+        self._index = {q.external_ref: i for i, q in enumerate(quantities)}
+        self._cm = None
+        self._lu = None  # LU factors of the background (I - A), computed on first use with solver='factorize'
+        self._fg_lu = None
+
+    @property
+    def quantities(self):
+        return (q for q in self._quantities)
+
+    @property
+    def ndim(self):
+        return self._flat.ndim
+
+    def index(self, quantity):
+        """
+        :param quantity: a quantity or its external_ref
+        :return: the row of the characterization matrix for the quantity
+        """
+        return self._index[getattr(quantity, 'external_ref', quantity)]
+
+    @property
+    def characterization(self):
+        """
+        The characterization factors of all quantities for every emission in the background, as a sparse
+        (quantities x emissions) matrix.  Emissions that appear more than once (e.g. in different compartments) are
+        looked up once per flow.
+        :return:
+        """
+        if self._cm is None:
+            self._cm = self._cf_rows(self._quantities)
+        return self._cm
+
+    def _cf_rows(self, quantities):
+        flows = dict()
+        rows, cols, data = [], [], []
+        ex = self._flat.ex
+        for j, em in enumerate(ex):
+            if em.flow_ref not in flows:
+                flows[em.flow_ref] = self._query.get(em.flow_ref)
+            flow = flows[em.flow_ref]
+            for i, q in enumerate(quantities):
+                v = q.cf(flow)
+                if v != 0:
+                    rows.append(i)
+                    cols.append(j)
+                    data.append(v)
+        return sparse.csr_matrix((data, (rows, cols)), shape=(len(quantities), len(ex)))
+
+    def add_quantity(self, quantity):
+        """
+        Add a quantity as a new row of the characterization matrix, if the matrix has already been built
+        :param quantity:
+        :return:
+        """
+        if quantity.external_ref in self._index:
+            return
+        self._index[quantity.external_ref] = len(self._quantities)
+        self._quantities = tuple(self._quantities) + (quantity,)
+        if self._cm is not None:
+            self._cm = sparse.vstack([self._cm, self._cf_rows((quantity,))]).tocsr()
+
+    @property
+    def _technology(self):
+        return sparse.eye(self.ndim, format='csc') - self._flat._A.tocsc()
+
+    def _factorize(self):
+        with self._metrics.phase('factorize'):
+            m = self._technology
+            if self._lu_cache is None:
+                return LuFactors.factorize(m)
+            origin = re.sub('[^\\w.-]', '_', str(getattr(self._query, 'origin', 'background')))
+            path = os.path.join(self._lu_cache, 'lu_%s_%s' % (origin, matrix_checksum(m)))
+            if os.path.exists(path):
+                self._metrics.report('lu_cache', 'Loading LU factors from %s' % path, path=path)
+                return LuFactors.load(path)
+            lu = LuFactors.factorize(m)
+            os.makedirs(self._lu_cache, exist_ok=True)
+            lu.save(path)
+            self._metrics.report('lu_cache', 'Saved LU factors to %s' % path, path=path)
+            return lu
+
+    def _bg_solve(self, y, solver=None):
+        """
+        Solve (I - A) x = y for one or more columns
+        :param y: dense (ndim x k) array
+        :param solver: [None] 'factorize' to use (and keep) the LU factors of (I - A); otherwise a direct sparse solve
+        :return: dense (ndim x k) array
+        """
+        if solver == 'factorize':
+            if self._lu is None:
+                self._lu = self._factorize()
+            return self._lu.solve(y)
+        x = spsolve(self._technology, y)
+        if sparse.issparse(x):
+            x = x.toarray()
+        return np.asarray(x).reshape(self.ndim, -1)
+
+    def _fg_solve(self, y):
+        if self._fg_lu is None:
+            af = self._flat._af
+            self._fg_lu = splu(sparse.eye(af.shape[0], format='csc') - af.tocsc())
+        return self._fg_lu.solve(y)
+
+    @property
+    def lci_cache(self):
+        return self._lci_cache
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    def lci_matrix(self, refs, solver=None):
+        """
+        Compute the emissions of several processes at once.  Background demands are stacked into a single
+        (ndim x k) right-hand side and solved together; foreground processes are first solved against the
+        foreground, and their background dependencies join the same right-hand side.  LCIs found in the LCI cache
+        are not solved again.
+        :param refs: list of (process_ref, flow_ref) pairs
+        :param solver: [None] 'factorize' to solve against cached LU factors
+        :return: an (emissions x k) array, one column per entry in refs
+        """
+        if self._lci_cache is None:
+            return self._timed_solve(refs, solver=solver)
+        cols = [self._lci_cache.get(tuple(r)) for r in refs]
+        missing = [i for i, c in enumerate(cols) if c is None]
+        if len(missing) > 0:
+            em = self._timed_solve([refs[i] for i in missing], solver=solver)
+            for j, i in enumerate(missing):
+                self._lci_cache.put(tuple(refs[i]), em[:, j])
+                cols[i] = em[:, j]
+        return np.column_stack([np.asarray(c, dtype=float) for c in cols])
+
+    def _timed_solve(self, refs, solver=None):
+        if solver == 'factorize' and self._lu is None:
+            self._lu = self._factorize()  # timed on its own, not as part of the first solve
+        with self._metrics.phase('solve'):
+            em = self._solve_lci(refs, solver=solver)
+        self._metrics.count('lcis_solved', len(refs))
+        return em
+
+    def _solve_lci(self, refs, solver=None):
+        flat = self._flat
+        k = len(refs)
+        y = np.zeros((self.ndim, k))
+        fg_cols = []
+        for col, (process_ref, flow_ref) in enumerate(refs):
+            i = flat.index_of(process_ref, flow_ref)
+            if flat.is_in_background(process_ref, flow_ref):
+                y[i, col] = 1.0
+            else:
+                fg_cols.append((col, i))
+        em_fg = None
+        if len(fg_cols) > 0:
+            e = np.zeros((flat._af.shape[0], len(fg_cols)))
+            for j, (col, i) in enumerate(fg_cols):
+                e[i, j] = 1.0
+            x_fg = self._fg_solve(e)
+            cols = [col for col, _ in fg_cols]
+            y[:, cols] = flat._ad.dot(x_fg)
+            em_fg = flat._bf.dot(x_fg)
+        em = np.asarray(flat._B.dot(self._bg_solve(y, solver=solver)))
+        if em_fg is not None:
+            em[:, [col for col, _ in fg_cols]] += em_fg
+        return em
+
+    def lci_vector(self, process_ref, flow_ref, **kwargs):
+        """
+        :param process_ref:
+        :param flow_ref:
+        :param kwargs: passed to lci_matrix(), e.g. solver='factorize'
+        :return: the emissions of the process's reference flow, as an (emissions x 1) array
+        """
+        return self.lci_matrix([(process_ref, flow_ref)], **kwargs)
+
+    def scores_matrix(self, refs, **kwargs):
+        """
+        :param refs: list of (process_ref, flow_ref) pairs
+        :param kwargs: passed to lci_matrix()
+        :return: a (quantities x k) array of scores, rows in the order of self.quantities
+        """
+        lci = self.lci_matrix(refs, **kwargs)
+        cm = self.characterization
+        with self._metrics.phase('characterize'):
+            return np.asarray(cm.dot(lci))
+
+    def scores(self, process_ref, flow_ref, **kwargs):
+        """
+        :param process_ref:
+        :param flow_ref:
+        :param kwargs: passed to lci_matrix()
+        :return: a 1d array with one score per quantity, in the order of self.quantities
+        """
+        return self.scores_matrix([(process_ref, flow_ref)], **kwargs).ravel()
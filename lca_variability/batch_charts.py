@@ -0,0 +1,233 @@
+"""
+Batch rendering of market figures (see mca_charts.mc_mkt_combo) to files.
+
+Figures are described first, in this process, by MarketFigure objects: the histogram of each Monte Carlo result is
+computed once as an McHistogram (from the samples, or from the result's sketch), together with the supplier scores
+and shares to draw over it.  The descriptions are small and picklable, so they are then drawn on a pool of worker
+processes, each figure on its own matplotlib Figure with the Agg canvas.  Nothing goes through pyplot, so rendering
+is headless and no figure is left open.
+
+Sources are Bw2McaMarketWeight containers (one figure per method) or a MarketIterator (one figure per market and
+quantity), optionally paired with Monte Carlo containers for its markets.
+"""
+
+import os
+import re
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .mca_charts import McHistogram, TraceLine, mc_mkt_combo
+
+
+def _safe_name(name):
+    return re.sub('[^\\w.-]+', '_', name).strip('_')
+
+
+class MarketFigure(object):
+    """
+    Everything needed to draw one market figure, with the Monte Carlo histogram already computed
+    """
+    def __init__(self, name, hist, xvals, shares, annot, style='stem', traces=None, show_ci=False):
+        """
+
+        :param name: file name for the figure, without extension
+        :param hist: an McHistogram
+        :param xvals: supplier scores
+        :param shares: supplier market shares
+        :param annot: dict with 'title', 'method' and (for style 'stem') 'ei'
+        :param style: ['stem'] see mc_mkt_combo
+        :param traces: [None] list of TraceLines
+        :param show_ci: [False] see McHistogram.draw()
+        """
+        self.name = name
+        self.hist = hist
+        self.xvals = list(xvals)
+        self.shares = list(shares)
+        self.annot = dict(annot)
+        self.style = style
+        self.traces = traces
+        self.show_ci = show_ci
+
+    def draw(self, ax):
+        mc_mkt_combo(ax, self.xvals, self.shares, self.hist, self.annot, style=self.style, traces=self.traces,
+                     show_ci=self.show_ci)
+        ax.legend()
+
+
+def _method_key(container, method):
+    return next(k for k, v in container._m_map.items() if v == method)
+
+
+def _container_hist(container, method, use_sketch=False, **kwargs):
+    if getattr(container, 'stratified', False):
+        return McHistogram(container.scores(method), weights=container.weights(method), **kwargs)
+    if use_sketch:
+        return McHistogram(container.sketch(method), **kwargs)
+    return McHistogram(container.scores(method), **kwargs)
+
+
+def container_figures(container, methods=None, style='stem', show_ci=False, use_sketch=False, **kwargs):
+    """
+    One figure per method for a Bw2McaMarketWeight container.  Each supplier is drawn at the median of the scores
+    drawn from it; suppliers that have not been sampled are left out.
+    :param container: a Bw2McaMarketWeight
+    :param methods: [None] default is all of the container's methods
+    :param style: ['stem']
+    :param show_ci: [False]
+    :param use_sketch: [False] compute unweighted histograms from the container's sketches instead of its samples.
+     Stratified results are always weighted from the samples.
+    :param kwargs: passed to McHistogram, e.g. bins, log_correct, log_scale
+    :return: list of MarketFigures
+    """
+    act = container.activity
+    figs = []
+    for m in methods or list(container.methods):
+        hist = _container_hist(container, m, use_sketch=use_sketch, density=style == 'norm', **kwargs)
+        xvals, shares = [], []
+        for sc, sh in zip(container.supplier_scores(m), container.market_shares):
+            if len(sc) > 0:
+                xvals.append(float(np.median(sc)))
+                shares.append(sh)
+        annot = {'title': '%s [%s]' % (act.get('name'), act.get('location')),
+                 'method': ': '.join(m),
+                 'ei': container.database}
+        name = _safe_name('%s_%s' % (act.get('activity'), _method_key(container, m)))
+        figs.append(MarketFigure(name, hist, xvals, shares, annot, style=style, show_ci=show_ci))
+    return figs
+
+
+def iterator_figures(iterator, mca=None, methods=None, style='stem', show_ci=False, use_sketch=False, **kwargs):
+    """
+    One figure per computed market and quantity of a MarketIterator, with the supplier scores and exchange values
+    drawn over a Monte Carlo histogram, and the market score as a trace.  Markets missing from mca are drawn over the
+    histogram of their supplier scores, weighted by exchange value: on a linear axis if any score is negative, and not
+    at all if every score is zero.  Figures whose histogram cannot be computed are skipped, and the number skipped is
+    reported.
+    :param iterator: a MarketIterator
+    :param mca: [None] dict of market external_ref to Bw2McaContainer
+    :param methods: [None] the container method matching each of the iterator's quantities, in order.  Required with
+     mca.
+    :param style: ['stem']
+    :param show_ci: [False]
+    :param use_sketch: [False] see container_figures
+    :param kwargs: passed to McHistogram
+    :return: list of MarketFigures
+    """
+    mca = mca or dict()
+    quantities = list(iterator.quantities)
+    if len(mca) > 0 and (methods is None or len(methods) != len(quantities)):
+        raise ValueError('methods must give a method for each of the %d quantities' % len(quantities))
+    figs = []
+    skipped = 0
+    for res in iterator.results:
+        c = mca.get(res.market_ref)
+        for i, q in enumerate(quantities):
+            try:
+                xvals = res.scores(q)
+                shares = res.exchange_values
+                traces = [TraceLine(res.market_scores[i], label='Market average')]
+                if c is None:
+                    x = np.asarray(xvals, dtype=float)
+                    if not np.any(x != 0):
+                        skipped += 1
+                        continue
+                    h_kwargs = dict(kwargs)
+                    if np.any(x < 0):
+                        h_kwargs.update(log_scale=False, log_correct=False)
+                    hist = McHistogram(xvals, weights=shares, density=style == 'norm', **h_kwargs)
+                    method = q['Name']
+                else:
+                    hist = _container_hist(c, methods[i], use_sketch=use_sketch, density=style == 'norm', **kwargs)
+                    method = ': '.join(methods[i])
+            except (KeyError, ValueError) as e:
+                print('%s %s: %s: %s' % (res.market_ref, q.external_ref, type(e).__name__, e))
+                skipped += 1
+                continue
+            annot = {'title': res.name, 'method': method, 'ei': iterator.origin}
+            name = _safe_name('%s_%s' % (res.market_ref, q.external_ref))
+            figs.append(MarketFigure(name, hist, xvals, shares, annot, style=style, traces=traces,
+                                     show_ci=show_ci))
+    if skipped > 0:
+        print('Skipped %d of %d figures with no scores to draw' % (skipped, skipped + len(figs)))
+    return figs
+
+
+def _render_worker(args):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    figs, folder, fmt, figsize, dpi = args
+    paths = []
+    failed = []
+    for fig_spec in figs:
+        fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(fig)
+        path = os.path.join(folder, '%s.%s' % (fig_spec.name, fmt))
+        try:
+            fig_spec.draw(fig.add_subplot(1, 1, 1))
+            fig.savefig(path, format=fmt, bbox_inches='tight')
+        except Exception as e:  # one bad figure must not abort the rest of the batch
+            failed.append((fig_spec.name, '%s: %s' % (type(e).__name__, e)))
+            continue
+        paths.append(path)
+    return paths, failed
+
+
+def render_figures(figures, folder, fmt='png', workers=None, figsize=(8, 5), dpi=100, chunk=8):
+    """
+    Draw MarketFigures to files, on a pool of worker processes
+    :param figures: list of MarketFigures
+    :param folder: output directory (created if needed)
+    :param fmt: ['png'] any format the Agg canvas can write, e.g. 'pdf', 'svg', 'eps'
+    :param workers: [None] number of worker processes; None or 1 renders here
+    :param figsize: [(8, 5)] inches
+    :param dpi: [100]
+    :param chunk: [8] figures sent to a worker at a time
+    :return: list of file names, in the order of figures.  Figures that fail to draw are reported and left out.
+    """
+    tstart = time.time()
+    os.makedirs(folder, exist_ok=True)
+    jobs = [(figures[i:i + chunk], folder, fmt, figsize, dpi) for i in range(0, len(figures), chunk)]
+    workers = int(workers or 1)
+    paths = []
+    failed = []
+    if workers <= 1:
+        for job in jobs:
+            p, f = _render_worker(job)
+            paths.extend(p)
+            failed.extend(f)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for p, f in pool.map(_render_worker, jobs):
+                paths.extend(p)
+                failed.extend(f)
+                if len(paths) // 100 > (len(paths) - len(p)) // 100:
+                    print('Rendered %d figures (%.3f sec)' % (len(paths), time.time() - tstart))
+    for name, err in failed:
+        print('%s: %s' % (name, err))
+    if len(failed) > 0:
+        print('Skipped %d figures that failed to draw' % len(failed))
+    print('Rendered %d figures to %s (%.3f sec)' % (len(paths), folder, time.time() - tstart))
+    return paths
+
+
+def render_markets(source, folder, fmt='png', workers=None, figsize=(8, 5), dpi=100, **kwargs):
+    """
+    Render market figures for a list of Bw2McaMarketWeight containers or a MarketIterator
+    :param source: a MarketIterator, or a list of Bw2McaMarketWeight containers
+    :param folder: output directory
+    :param fmt: ['png']
+    :param workers: [None]
+    :param figsize: [(8, 5)]
+    :param dpi: [100]
+    :param kwargs: passed to iterator_figures or container_figures, e.g. mca, methods, style, show_ci, bins,
+     log_correct
+    :return: list of file names
+    """
+    if hasattr(source, 'results'):
+        figures = iterator_figures(source, **kwargs)
+    else:
+        figures = [f for c in source for f in container_figures(c, **kwargs)]
+    return render_figures(figures, folder, fmt=fmt, workers=workers, figsize=figsize, dpi=dpi)
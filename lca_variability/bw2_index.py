@@ -0,0 +1,116 @@
+"""
+Persistent index of ecoinvent activity UUIDs (the 'activity' field of a BW2 activity) to BW2 activity keys.
+
+Finding an activity by scanning Database(db_name) touches every activity in the database (~15k for ecoinvent).  The
+index is built once per database, saved in the project's 'lca_variability' directory, and rebuilt when the database's
+'modified' timestamp or activity count changes.  UUIDs are kept sorted, so exact and prefix lookups are a bisection.
+"""
+
+import os
+import re
+import json
+
+from bisect import bisect_left
+
+from brightway2 import Database, databases, projects, get_activity
+
+from .metrics import RunMetrics
+
+
+class ActivityIndex(object):
+    """
+    Sorted map of activity UUID to activity code for one BW2 database.  Where several activities share a UUID, the
+    first one encountered when iterating over the database is kept, as a linear scan would find.
+    """
+    def __init__(self, db_name, metrics=None):
+        """
+
+        :param db_name:
+        :param metrics: [None] a RunMetrics to deliver the message announcing a (re)build of the index
+        """
+        self._metrics = RunMetrics() if metrics is None else metrics
+        self._db = db_name
+        self._project = None
+        self._version = None
+        self._ids = []
+        self._codes = []
+
+    @property
+    def database(self):
+        return self._db
+
+    @property
+    def _current_version(self):
+        meta = databases[self._db]
+        return [meta.get('modified'), meta.get('number')]
+
+    @property
+    def filename(self):
+        safe = re.sub('[^\\w.-]', '_', self._db)
+        return os.path.join(projects.request_directory('lca_variability'), 'activity_index_%s.json' % safe)
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return False
+        with open(self.filename, 'r') as fp:
+            j = json.load(fp)
+        if j['version'] != self._current_version:
+            return False
+        self._ids = j['ids']
+        self._codes = j['codes']
+        self._version = j['version']
+        return True
+
+    def _build(self):
+        self._metrics.report('build_index', 'Building activity index for %s' % self._db, database=self._db)
+        found = dict()
+        for a in Database(self._db):
+            uuid = a.get('activity')
+            if uuid is not None and uuid not in found:
+                found[uuid] = a.key[1]
+        self._ids = sorted(found.keys())
+        self._codes = [found[k] for k in self._ids]
+        self._version = self._current_version
+        with open(self.filename, 'w') as fp:
+            json.dump({'version': self._version, 'ids': self._ids, 'codes': self._codes}, fp)
+
+    def _check(self):
+        if self._project != projects.current or self._version != self._current_version:
+            self._project = projects.current
+            if not self._load():
+                self._build()
+
+    def find(self, activity_id, prefix=False):
+        """
+        :param activity_id: activity UUID
+        :param prefix: [False] if True, activity_id may be a leading substring of the UUID.  If several UUIDs match,
+         the lowest is returned.
+        :return: the BW2 activity
+        """
+        self._check()
+        i = bisect_left(self._ids, activity_id)
+        if i < len(self._ids):
+            match = self._ids[i]
+            if match == activity_id or (prefix and match.startswith(activity_id)):
+                return get_activity((self._db, self._codes[i]))
+        raise KeyError(activity_id)
+
+
+_indices = dict()
+
+
+def find_activity(db_name, activity_id, prefix=False, metrics=None):
+    """
+    Look up a BW2 activity by its ecoinvent activity UUID, using a persistent per-database index.
+    :param db_name:
+    :param activity_id: activity UUID, or a prefix of one if prefix is True
+    :param prefix: [False]
+    :param metrics: [None] a RunMetrics for the index's messages, if the index is created by this call
+    :return:
+    """
+    if db_name not in _indices:
+        _indices[db_name] = ActivityIndex(db_name, metrics=metrics)
+    try:
+        return _indices[db_name].find(activity_id, prefix=prefix)
+    except KeyError:
+        raise ValueError('Activity not found: %s' % activity_id)
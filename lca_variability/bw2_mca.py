@@ -1,22 +1,33 @@
 """
-This module uses BW2 to generate and store Monte Carlo results fro already-configured databases.  Serializes results
-as JSON files in the working directory.  The files are named by the activity ID (uuid) and results strictly append.
-To start over you have to delete the file.
+This module uses BW2 to generate and store Monte Carlo results fro already-configured databases.  Results are stored
+in the working directory in an append-only result store (see mca_results.McaResultStore), a directory named by the
+activity ID (uuid) with a .mca extension.  Results strictly append; to start over you have to delete the directory.
+Result sets saved in the older .json.gz format are imported into the store the first time they are opened, and
+export_json() writes that format for interchange.
 """
 
 
 import os
 import time
 import re
+import queue
+import multiprocessing
 
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 # from argparse import ArgumentParser
 
+import numpy as np
+from scipy import sparse
+
 from lcatools import from_json, to_json
-from brightway2 import Database, MonteCarloLCA
-from bw2calc.matrices import MatrixBuilder
+from brightway2 import MonteCarloLCA, projects, get_activity
+from bw2calc.matrices import MatrixBuilder, TechnosphereBiosphereMatrixBuilder as TBM
 from bw2calc.utils import get_filepaths, global_index
 
+from .mca_results import McaResultStore, ScoreArray, ScoreSketch
+from .metrics import RunMetrics
+from .bw2_index import find_activity
+
 
 def _generate_c_matrix(method, biosphere_dict):
     """
@@ -35,52 +46,159 @@ def _generate_c_matrix(method, biosphere_dict):
     return c_m
 
 
+class _MatrixRefill(object):
+    """
+    Rebuilds a sparse matrix with a fixed sparsity structure from a new vector of parameter values.  Equivalent to
+    MatrixBuilder.build_matrix (values at duplicate coordinates are summed) but the coordinates are sorted only once,
+    so each rebuild is a single bincount.
+    """
+    def __init__(self, params, shape, row='row', col='col'):
+        keys = params[row].astype(np.int64) * shape[1] + params[col]
+        uniq, self._inv = np.unique(keys, return_inverse=True)
+        self._indices = (uniq % shape[1]).astype(np.int32)
+        self._indptr = np.searchsorted(uniq // shape[1], np.arange(shape[0] + 1)).astype(np.int32)
+        self._shape = shape
+
+    def __call__(self, vector):
+        data = np.bincount(self._inv, weights=vector, minlength=len(self._indices))
+        return sparse.csr_matrix((data, self._indices, self._indptr), shape=self._shape)
+
+
+def _worker_seeds(seed, start, workers):
+    """
+    Independent, reproducible seeds for a set of parallel workers.  The stream depends on the container's seed and on
+    the number of samples already taken, so that topping up a result set never repeats earlier draws.
+    :param seed: base seed, or None for fresh entropy
+    :param start: number of samples already taken
+    :param workers: number of seeds to generate
+    :return: a list of ints suitable for seeding a MonteCarloLCA
+    """
+    ss = np.random.SeedSequence(seed, spawn_key=(start,))
+    return [int(c.generate_state(1)[0] >> 1) for c in ss.spawn(workers)]
+
+
+def _mca_worker(args):
+    """
+    Runs in a worker process: builds a fresh, unsaved container with its own seed and scores n draws.
+    :param args: container class, project name, activity key, list of (key, method), n, seed, block size, progress
+     queue (each completed block puts its size on the queue), dict of further constructor arguments
+    :return: a 3-tuple: (n x methods) array of scores, worker state to be merged by the parent, the worker's
+     RunMetrics
+    """
+    cls, project, act_key, methods, n, seed, block_size, progress, kwargs = args
+    projects.set_current(project, writable=False)
+    b = cls(get_activity(act_key), seed=seed, block_size=block_size, _do_load=False, **kwargs)
+    for key, method in methods:
+        b.add_method(method, key=key, _suppress_update=True)
+    blocks = []
+    done = 0
+    while done < n:
+        k = min(b._block_size, n - done)
+        blocks.append(b._score_block(k))
+        done += k
+        progress.put(k)
+    return np.vstack(blocks), b._worker_state(), b.metrics
+
+
 class Bw2McaContainer(object):
 
     FILE_PREFIX = 'BW2_null'
+    BLOCK_SIZE = 25  # default number of draws scored per call to _score_block()
 
     @classmethod
-    def from_file(cls, filename, folder=None):
+    def from_file(cls, filename, folder=None, metrics=None):
+        """
+        Restore a container from its result store (.mca directory) or from a .json.gz file.  A JSON file is imported
+        into the result store the first time it is opened; after that the store is used.
+        :param filename:
+        :param folder: [None] default is the directory containing filename
+        :param metrics: [None] a RunMetrics for the container
+        :return:
+        """
+        if metrics is None:
+            metrics = RunMetrics()
         if folder is None:
             folder = os.path.dirname(os.path.abspath(filename))
         if not os.path.isabs(filename):
             filename = os.path.join(folder, filename)
-        j = from_json(filename)
+        filename = filename.rstrip(os.sep)
 
-        activity_id = re.search('%s_(.+)\.json\.gz$' % cls.FILE_PREFIX, filename).group(1)
-        act = next(a for a in Database(j['database']) if a.get('activity') == activity_id)
+        activity_id = re.search('%s_(.+)\.(json\.gz|mca)$' % cls.FILE_PREFIX, filename).group(1)
+        store = McaResultStore(os.path.join(folder, '%s_%s.mca' % (cls.FILE_PREFIX, activity_id)))
+        if not store.exists:
+            metrics.report('import', 'Importing %s' % filename, filename=filename)
+            cls._import_json(store, from_json(filename))
+        act = find_activity(store.meta['database'], activity_id, metrics=metrics)
 
-        b = cls(act, folder=folder, _do_load=False)
-        b._install_data(j)
-        b._update_results()
-        return b
+        return cls(act, folder=folder, metrics=metrics)
+
+    @classmethod
+    def _import_json(cls, store, j):
+        """
+        One-time import of a serialized result set (see export_json) into a result store
+        :param store: McaResultStore
+        :param j:
+        :return:
+        """
+        store.import_json(j)
 
-    def _install_data(self, j):
-        for k, v in j['method_map'].items():
+    def _install_store(self, steps):
+        meta = self._store.meta
+        for k, v in meta['method_map'].items():
             self.add_method(tuple(v), key=k, _suppress_update=True)
 
-        for k, v in j['results'].items():
-            self._res[k].extend(v)
+        for k in self._store.keys:
+            self._res.extend(k, self._store.load(k))
 
-        self._steps = j['steps']
+        for k, j in meta.get('sketches', dict()).items():
+            if j['n'] + j.get('nonfinite', 0) == self._res.count(k):
+                self._sketches[k] = ScoreSketch.from_json(j)
+        self._update_sketches()  # any that were missing or out of step are rebuilt from the samples
+
+        self._steps = max([steps, int(meta['steps'])])
 
     def _load_file(self, steps):
         if steps is None:
             steps = 0
-        if os.path.exists(self.full_path):
-            j = from_json(self.full_path)
-            assert(j['database'] == self.database)
-            j['steps'] = max([steps, int(j['steps'])])
-            self._install_data(j)
+        if not self._store.exists and os.path.exists(self.full_path):
+            self._metrics.report('import', 'Importing %s' % self.full_path, filename=self.full_path)
+            self._import_json(self._store, from_json(self.full_path))
+        if self._store.exists:
+            assert(self._store.meta['database'] == self.database)
+            self._install_store(steps)
         else:
             self._steps = steps
 
-    def __init__(self, activity, *args, folder=None, steps=None, _do_load=True):
+    def __init__(self, activity, *args, folder=None, steps=None, block_size=None, seed=None, workers=None,
+                 memmap=False, metrics=None, _do_load=True):
+        """
+
+        :param activity: the BW2 activity to simulate
+        :param args: LCIA methods to score
+        :param folder: [None] where to store results (default: working directory)
+        :param steps: [None] minimum number of samples
+        :param block_size: [BLOCK_SIZE] number of Monte Carlo draws to generate and score at a time
+        :param seed: [None] random seed.  Parallel runs derive their worker seeds from it.
+        :param workers: [None] number of worker processes to use for new samples. None or 1 runs serially.
+        :param memmap: [False] hold the scores in a memory-mapped scratch file instead of RAM.  True for a temporary
+         file, or a filename prefix.
+        :param metrics: [None] a RunMetrics to record phase timings and counts in, and to deliver progress messages
+         (printed, unless it has a callback)
+        :param _do_load:
+        """
         self._folder = folder
+        self._block_size = int(block_size or self.BLOCK_SIZE)
+        self._seed = seed
+        self._workers = int(workers or 1)
         self._a = activity
+        self._metrics = RunMetrics() if metrics is None else metrics
+        self._store = McaResultStore(self.store_path)
         self._m_map = dict()  # map method name (hashable) to tuple
         self._c_ms = dict()  # c matrices
-        self._res = defaultdict(list)
+        self._keys = []  # row order of the stacked characterization matrix
+        self._cm = None  # stacked characterization matrix, methods x biosphere
+        self._res = ScoreArray(capacity=max(1024, steps or 0), filename=memmap or None)
+        self._sketches = dict()  # key -> ScoreSketch of the method's samples
         self._steps = 0
         if _do_load:
             self._load_file(steps)
@@ -93,6 +211,29 @@ class Bw2McaContainer(object):
     def _next_inventory(self):
         raise NotImplementedError
 
+    def _next_emissions(self, k):
+        """
+        Generate k Monte Carlo draws and return their total emissions (inventory row sums) as a (biosphere x k) array.
+        Subclasses should override this if they can avoid forming the full inventory matrix for each draw.
+        :param k:
+        :return:
+        """
+        cols = []
+        for _ in range(k):
+            inv = self._next_inventory()
+            with self._metrics.phase('inventory'):
+                cols.append(np.asarray(inv.sum(axis=1)).ravel())
+        return np.column_stack(cols)
+
+    @property
+    def metrics(self):
+        """
+        The RunMetrics holding this container's phase timings ('sample', 'rebuild', 'solve', 'inventory', 'score',
+        'sketch', 'write', 'update', and for market models 'choose' and 'draw') and counters ('samples', 'results',
+        'bytes_written')
+        """
+        return self._metrics
+
     @property
     def activity(self):
         return self._a
@@ -110,6 +251,14 @@ class Bw2McaContainer(object):
     def steps(self):
         return self._steps
 
+    @property
+    def workers(self):
+        return self._workers
+
+    @workers.setter
+    def workers(self, value):
+        self._workers = int(value or 1)
+
     @property
     def full_path(self):
         if self._folder is None:
@@ -120,59 +269,274 @@ class Bw2McaContainer(object):
     def filename(self):
         return '%s_%s.json.gz' % (self.FILE_PREFIX, self._a.get('activity'))
 
+    @property
+    def store_path(self):
+        name = '%s_%s.mca' % (self.FILE_PREFIX, self._a.get('activity'))
+        if self._folder is None:
+            return os.path.abspath(name)
+        return os.path.join(os.path.abspath(self._folder), name)
+
     def _write_file(self):
-        j = {'database': self.database,
-             'steps': self.steps,
-             'method_map': {k: list(v) for k, v in self._m_map.items()},
-             'results': {k: v for k, v in self._res.items()}
-             }
-        to_json(j, self.full_path, gzip=True)
-        print('Written to %s' % os.path.abspath(self.full_path))
+        """
+        Append the samples added since the last write to the result store
+        :return:
+        """
+        nbytes = 0
+        with self._metrics.phase('write'):
+            for k in self._res.keys():
+                nbytes += self._store.append(k, self._res[k][self._store.length(k):])
+            self._store.commit(self.database, self.steps, self._m_map, **self._store_meta())
+        self._metrics.count('bytes_written', nbytes)
+        self._metrics.report('write', 'Appended %d bytes to %s' % (nbytes, self._store.path), nbytes=nbytes,
+                             path=self._store.path)
+
+    def _store_meta(self):
+        """
+        Additional metadata to record in the result store: the score sketches, and anything subclass-specific
+        :return:
+        """
+        return {'sketches': {k: sk.serialize() for k, sk in self._sketches.items()}}
+
+    def _update_sketches(self):
+        """
+        Bring each method's sketch up to date by adding the samples it has not yet seen
+        :return:
+        """
+        with self._metrics.phase('sketch'):
+            for k in self._res.keys():
+                sk = self._sketches.setdefault(k, ScoreSketch())
+                sk.update(self._res[k][sk.seen:])
+
+    def sketch(self, method):
+        """
+        A ScoreSketch summarizing all of the method's scores (unweighted): moments, approximate intervals and
+        histograms without reading the samples.  Sketches are saved with the results.
+        :param method:
+        :return:
+        """
+        key = next(k for k, v in self._m_map.items() if v == method)
+        self._update_sketches()
+        return self._sketches[key]
+
+    def _serialize(self):
+        return {'database': self.database,
+                'steps': self.steps,
+                'method_map': {k: list(v) for k, v in self._m_map.items()},
+                'results': {k: self._res[k].tolist() for k in self._res.keys()}
+                }
+
+    def export_json(self, filename=None):
+        """
+        Write the complete result set to a single gzipped JSON file, for interchange.
+        :param filename: [None] default is self.full_path
+        :return:
+        """
+        if filename is None:
+            filename = self.full_path
+        to_json(self._serialize(), filename, gzip=True)
+        self._metrics.report('export', 'Written to %s' % os.path.abspath(filename), filename=os.path.abspath(filename))
+
+    def _c_matrix(self, method):
+        """
+        The method's (diagonal) characterization matrix over self.biosphere
+        :param method:
+        :return:
+        """
+        return _generate_c_matrix(method, self.biosphere)
+
+    @property
+    def _characterization(self):
+        """
+        The characterization vectors of all registered methods, stacked into a single sparse (methods x biosphere)
+        matrix whose rows are in the order of self._keys.  Rebuilt lazily after methods are added.
+        :return:
+        """
+        if self._cm is None:
+            self._keys = sorted(self._c_ms.keys())
+            self._cm = sparse.vstack([sparse.csr_matrix(self._c_ms[k].diagonal()) for k in self._keys]).tocsr()
+        return self._cm
+
+    def _score_block(self, k):
+        """
+        Generate k Monte Carlo draws and score each of them against every registered method.  Since each
+        characterization matrix is diagonal, (cm * inventory).sum() is the dot product of the characterization vector
+        with the inventory row sums, so the whole block is scored with one product.
+        :param k: number of draws
+        :return: a (k x methods) array of scores, columns in the order of self._keys
+        """
+        cm = self._characterization
+        em = self._next_emissions(k)
+        with self._metrics.phase('score'):
+            scores = np.asarray(cm.dot(em)).T
+        self._metrics.count('samples', k)
+        return scores
 
     @property
     def _up_to_date(self):
-        ck = all(len(v) >= self.steps for v in self._res.values())
+        ck = all(self._res.count(k) >= self.steps for k in self._res.keys())
         if ck and len(self._res) > 0:
-            print('Up to date with %d samples, %d methods' % (self.steps, len(self._res)))
+            self._metrics.report('up_to_date', 'Up to date with %d samples, %d methods' % (self.steps, len(self._res)),
+                                 steps=self.steps, methods=len(self._res))
         return ck
 
-    def _update_results(self):
+    @property
+    def _drawn(self):
+        """
+        The number of draws already taken: the sample count of the longest method.  Methods added later catch up on
+        new draws, so this, and not the shortfall, is the offset of the next draw in the stream.
+        """
+        return max([self._res.count(k) for k in self._res.keys()] + [0])
+
+    @property
+    def _missing(self):
+        """
+        The number of draws required to bring every method up to date
+        """
+        return max(self.steps - self._res.count(k) for k in self._res.keys())
+
+    def _append_block(self, block):
         """
-        Ensure that every listed method has [at least] the required number of steps
+        Distribute a block of scores, in draw order, to the methods that are missing samples.  A method only takes as
+        many samples from the block as it is missing.
+        :param block: (k x methods) array, columns in the order of self._keys
+        :return: the number of results added
+        """
+        rcount = 0
+        for i, key in enumerate(self._keys):
+            short = self.steps - self._res.count(key)
+            if short <= 0:
+                continue
+            self._res.extend(key, block[:short, i])
+            rcount += min(short, len(block))
+        return rcount
+
+    def _worker_kwargs(self, sizes):
+        """
+        Subclass-specific constructor arguments the parallel workers need in order to reproduce this container's model
+        :param sizes: the number of draws each worker will make, in worker order
+        :return: a list of dicts, one per worker
+        """
+        return [dict() for _ in sizes]
+
+    def _worker_state(self):
+        """
+        Anything besides scores that a parallel worker must hand back to the parent, in draw order
         :return:
         """
+        return None
+
+    def _merge_worker_state(self, state):
+        pass
+
+    def _update_results(self):
         """
-        Ensure that every listed method has [at least] the required number of steps
+        Ensure that every listed method has [at least] the required number of steps.  Draws are generated and scored
+        in blocks of up to self._block_size, either in this process or spread across self.workers processes.
         :return:
         """
         if self._up_to_date:
             return
+        with self._metrics.phase('update'):
+            if self._workers > 1:
+                self._update_parallel()
+            else:
+                self._update_serial()
+            self._update_sketches()
+            self._write_file()
+
+    def _reseed(self, seed):
+        """
+        Restart the Monte Carlo stream from a new seed, if no draws have been made yet in this session
+        :param seed:
+        :return:
+        """
+        pass
+
+    def _update_serial(self):
+        if self._seed is not None:
+            # like the parallel path, continue from a stream derived from the seed and the samples already taken, so
+            # that topping up a reopened result set does not repeat its earlier draws
+            self._reseed(_worker_seeds(self._seed, self._drawn, 1)[0])
         tstart = time.time()
         count = rcount = 0
         while not self._up_to_date:
-            count += 1
-            inventory = self._next_inventory()
-            for k, cm in self._c_ms.items():
-                if len(self._res[k]) >= self.steps:
-                    continue
-                res = cm * inventory
-                self._res[k].append(res.sum())
-                rcount += 1
-            if count % 100 == 0:
-                print('Completed %i MCA samples (%.3f sec)' % (count, time.time() - tstart))
-        print('Added %i results from %i MCA samples (%.3f sec)' % (rcount, count, time.time() - tstart))
-        self._write_file()
+            k = min(self._block_size, self._missing)
+            rcount += self._append_block(self._score_block(k))
+            count += k
+            if count // 100 > (count - k) // 100:
+                self._report_progress(count, tstart)
+        self._metrics.count('results', rcount)
+        elapsed = time.time() - tstart
+        self._metrics.report('complete', 'Added %i results from %i MCA samples (%.3f sec)' % (rcount, count, elapsed),
+                             results=rcount, samples=count, elapsed=elapsed)
+
+    def _report_progress(self, count, tstart, workers=1):
+        elapsed = time.time() - tstart
+        if workers > 1:
+            message = 'Completed %i MCA samples in %d workers (%.3f sec)' % (count, workers, elapsed)
+        else:
+            message = 'Completed %i MCA samples (%.3f sec)' % (count, elapsed)
+        self._metrics.report('progress', message, samples=count, elapsed=elapsed, workers=workers,
+                             rate=count / elapsed if elapsed > 0 else 0.0)
+
+    def _update_parallel(self):
+        """
+        Split the missing draws across worker processes.  Each worker builds its own Monte Carlo model with a seed
+        from _worker_seeds(); results are merged in worker order, so a run is reproducible for a given seed, starting
+        sample count and number of workers.
+        :return:
+        """
+        tstart = time.time()
+        _ = self._characterization  # fixes the column order in self._keys
+        need = self._missing
+        w = min(self._workers, need)
+        sizes = [need // w + (1 if i < need % w else 0) for i in range(w)]
+        seeds = _worker_seeds(self._seed, self._drawn, w)
+        methods = [(k, self._m_map[k]) for k in self._keys]
+
+        count = 0
+        with multiprocessing.Manager() as manager:
+            progress = manager.Queue()
+            with ProcessPoolExecutor(max_workers=w) as pool:
+                futures = [pool.submit(_mca_worker, (type(self), projects.current, self._a.key, methods, n, seed,
+                                                     self._block_size, progress, kw))
+                           for n, seed, kw in zip(sizes, seeds, self._worker_kwargs(sizes))]
+                while count < need and not all(f.done() for f in futures):
+                    try:
+                        k = progress.get(timeout=0.5)
+                    except queue.Empty:
+                        continue
+                    count += k
+                    if count // 100 > (count - k) // 100:
+                        self._report_progress(count, tstart, workers=w)
+                results = [f.result() for f in futures]
+
+        for _, state, metrics in results:
+            self._merge_worker_state(state)
+            self._metrics.merge(metrics)
+        rcount = self._append_block(np.vstack([block for block, _, _ in results]))
+        self._metrics.count('results', rcount)
+        elapsed = time.time() - tstart
+        self._metrics.report('complete', 'Added %i results from %i MCA samples in %d workers (%.3f sec)' % (
+            rcount, need, w, elapsed), results=rcount, samples=need, workers=w, elapsed=elapsed)
 
     @steps.setter
     def steps(self, value):
         value = int(value)
         if value > self._steps:
             self._steps = value
+            self._res.reserve(value)
         self._update_results()
 
     def scores(self, method):
+        """
+        :param method:
+        :return: a read-only view of the method's scores as a float64 array (not a copy-- use np.array() to keep it)
+        """
         key = next(k for k, v in self._m_map.items() if v == method)
-        return self._res[key]
+        view = self._res[key]
+        view.flags.writeable = False
+        return view
 
     def add_method(self, method, key=None, _suppress_update=False):
         """
@@ -186,8 +550,9 @@ class Bw2McaContainer(object):
             key = '__'.join(method)
         self._m_map[key] = method
         if method not in self.methods:
-            self._res[key].extend([])
-        self._c_ms[key] = _generate_c_matrix(method, self.biosphere)
+            self._res.add_key(key)
+        self._c_ms[key] = self._c_matrix(method)
+        self._cm = None
         if _suppress_update:
             return
         self._update_results()
@@ -202,27 +567,74 @@ class Bw2McaSimple(Bw2McaContainer):
 
     FILE_PREFIX = 'BW2_MCA'
 
-    def __init__(self, activity, *args, **kwargs):
-        self._sol = MonteCarloLCA({activity: 1}, method=None)
+    def __init__(self, activity, *args, seed=None, **kwargs):
+        self._sol = MonteCarloLCA({activity: 1}, method=None, seed=seed)
         self._sol.load_lci_data()
         self._biosphere_dict = self._sol._biosphere_dict
-        super(Bw2McaSimple, self).__init__(activity, *args, **kwargs)
+        self._tech_fill = None
+        self._bio_fill = None
+        super(Bw2McaSimple, self).__init__(activity, *args, seed=seed, **kwargs)
 
     @property
     def biosphere(self):
         return self._biosphere_dict
 
+    def _reseed(self, seed):
+        if not hasattr(self._sol, 'tech_rng'):
+            self._sol.seed = seed
+
     def _next_inventory(self):
         next(self._sol)
         return self._sol.inventory
 
+    def _next_emissions(self, k):
+        """
+        Draw k parameter vectors from the technosphere and biosphere generators-- in the same order as k calls to
+        next(self._sol), so results match the sequential path for the same seed-- then solve each system and reduce
+        the supply vector directly to biosphere totals, without forming the (biosphere x activities) inventory.
+        :param k:
+        :return:
+        """
+        sol = self._sol
+        if not hasattr(sol, 'tech_rng'):
+            sol.load_data()
+        if not hasattr(sol, 'demand_array'):
+            sol.build_demand_array()
+        if self._tech_fill is None:
+            self._tech_fill = _MatrixRefill(sol.tech_params, sol.technosphere_matrix.shape)
+            self._bio_fill = _MatrixRefill(sol.bio_params, sol.biosphere_matrix.shape)
+
+        metrics = self._metrics
+        with metrics.phase('sample'):
+            tech = np.column_stack([sol.tech_rng.next() for _ in range(k)])
+            bio = np.column_stack([sol.bio_rng.next() for _ in range(k)])
+
+        emissions = np.empty((len(self._biosphere_dict), k))
+        for i in range(k):
+            with metrics.phase('rebuild'):
+                sol.technosphere_matrix = self._tech_fill(TBM.fix_supply_use(sol.tech_params, tech[:, i].copy()))
+                sol.biosphere_matrix = self._bio_fill(bio[:, i])
+                if getattr(sol, 'presamples', None):
+                    sol.presamples.update_matrices()
+            with metrics.phase('solve'):
+                supply = sol.solve_linear_system()
+            with metrics.phase('inventory'):
+                emissions[:, i] = sol.biosphere_matrix.dot(supply)
+        return emissions
+
+
+def initialize_activity(db_name, activity_id, *args, steps=100, **kwargs):
+    """
 
-def initialize_activity(db_name, activity_id, *args, steps=100):
-    try:
-        act = next(a for a in Database(db_name) if a.get('activity').startswith(activity_id))
-    except StopIteration:
-        raise ValueError('Activity not found: %s'% activity_id)
-    return Bw2McaSimple(act, *args, steps=steps)
+    :param db_name:
+    :param activity_id: activity UUID, or a unique prefix of one
+    :param args: LCIA methods
+    :param steps: [100]
+    :param kwargs: passed to Bw2McaSimple, e.g. seed, block_size, workers, folder
+    :return:
+    """
+    act = find_activity(db_name, activity_id, prefix=True, metrics=kwargs.get('metrics'))
+    return Bw2McaSimple(act, *args, steps=steps, **kwargs)
 
 
 '''
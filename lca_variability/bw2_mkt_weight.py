@@ -1,7 +1,11 @@
-from brightway2 import MonteCarloLCA, Database
+import os
+
+from brightway2 import MonteCarloLCA
 from .bw2_mca import Bw2McaContainer
-from random import random
-from numpy import cumsum
+from .bw2_index import find_activity
+from .mca_results import McaResultStore, ScoreArray
+from .metrics import RunMetrics
+import numpy as np
 
 
 class WeightedChooser(object):
@@ -9,53 +13,247 @@ class WeightedChooser(object):
     This random number generator accepts an ordered list of weights, and each iteration returns an index into the
     list chosen in proportion to the weights.  The frequency that a given index should appear should equal its weight
     value in proportion to the sum of all weights.
+
+    Draws use Walker's alias method (with Vose's table construction): the table is built once in O(n), after which
+    each draw costs one uniform integer and one uniform float, regardless of the number of weights.
+    """
+    def __init__(self, array, seed=None):
+        """
+
+        :param array: weights
+        :param seed: [None] seed (or SeedSequence) for the numpy Generator that drives the draws
+        """
+        self._a = array
+        self._prob, self._alias = self._alias_table(array)
+        self._rng = np.random.default_rng(seed)
+
+    @staticmethod
+    def _alias_table(array):
+        w = np.asarray(array, dtype=float)
+        n = len(w)
+        p = w * n / w.sum()
+        prob = np.ones(n)
+        alias = np.arange(n)
+        small = [i for i in range(n) if p[i] < 1.0]
+        large = [i for i in range(n) if p[i] >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = p[s]
+            alias[s] = l
+            p[l] = (p[l] + p[s]) - 1.0
+            if p[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # anything left over has probability 1 up to rounding error, which prob already reflects
+        return prob, alias
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        i = self._rng.integers(len(self._prob))
+        if self._rng.random() < self._prob[i]:
+            return int(i)
+        return int(self._alias[i])
+
+    def sample(self, k):
+        """
+        Draw k indices at once
+        :param k:
+        :return: an int array of length k
+        """
+        i = self._rng.integers(len(self._prob), size=k)
+        u = self._rng.random(size=k)
+        return np.where(u < self._prob[i], i, self._alias[i])
+
+    @property
+    def list(self):
+        return list(self._a)
+
+
+class StratifiedChooser(object):
+    """
+    A deterministic alternative to WeightedChooser: draws are allocated evenly to every index with a positive weight,
+    regardless of the size of the weight.  Each iteration returns the eligible index with the fewest draws so far
+    (the lowest such index on ties), so the indices come round in turn and after any number of draws no two eligible
+    indices differ by more than one draw.
+
+    The sample is no longer distributed in proportion to the weights; each draw must be weighted by
+    weight[i] / count[i] to recover the weighted mixture (see Bw2McaMarketWeight.weights).
     """
     def __init__(self, array):
+        """
+
+        :param array: weights.  Indices with zero or negative weight are never chosen.
+        """
         self._a = array
-        self._c = cumsum(array)
-        self._m = self._c[-1]
+        self._eligible = np.flatnonzero(np.asarray(array, dtype=float) > 0)
+        self._counts = np.zeros(len(array), dtype=np.int64)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        r = random() * self._m
-        return sum(r > self._c)  # this works despite lint because of numpy
+        i = self._eligible[np.argmin(self._counts[self._eligible])]
+        self._counts[i] += 1
+        return int(i)
+
+    def sample(self, k):
+        """
+        Draw k indices at once
+        :param k:
+        :return: an int array of length k
+        """
+        return np.array([next(self) for _ in range(k)], dtype=int)
+
+    def restore_counts(self, choices):
+        """
+        Account for draws made elsewhere (in an earlier session or a worker process), so that the allocation
+        continues from where they left off
+        :param choices: iterable of indices
+        :return:
+        """
+        choices = np.asarray(choices, dtype=np.int64)
+        self._counts += np.bincount(choices, minlength=len(self._counts))[:len(self._counts)]
+
+    def plan(self, k):
+        """
+        The next k indices, without drawing them
+        :param k:
+        :return: an int array of length k
+        """
+        counts = self._counts.copy()
+        try:
+            return self.sample(k)
+        finally:
+            self._counts = counts
+
+    @property
+    def counts(self):
+        return self._counts.copy()
 
     @property
     def list(self):
         return list(self._a)
 
 
+def _mode(stratified):
+    return 'stratified' if stratified else 'weighted'
+
+
+def choice_dtype(n):
+    """
+    The smallest unsigned integer type that can index n suppliers, keeping its maximum value free as a sentinel
+    :param n: number of suppliers
+    :return:
+    """
+    return np.dtype(np.uint16) if n < np.iinfo(np.uint16).max else np.dtype(np.uint32)
+
+
 class MarketMonteCarloIterator(object):
     """
     This takes in a BW2 activity, presumed to be a market process, and for each iteration returns a monte carlo
     inventory for one of the market suppliers (plus non-supplier inputs), chosen at random in proportion to each
     supplier's market share.
+
+    All suppliers share a single MonteCarloLCA, since they draw on the same database matrices: the model is built
+    with every supplier in its demand, and the demand vector for the chosen supplier is swapped in before each draw.
+    Each supplier's demand vector, and the solution used to warm-start the iterative solver, is created the first
+    time that supplier is chosen.
+
+    The supplier index of every draw is recorded in a compact unsigned integer array (see choice_dtype).
+
+    In stratified mode, suppliers are chosen in turn by a StratifiedChooser instead of at random, so that every
+    supplier with a nonzero market share receives the same number of draws.
     """
-    def __init__(self, market):
+    def __init__(self, market, seed=None, stratified=False, metrics=None, schedule=None):
+        """
+
+        :param market:
+        :param seed: [None] seeds the supplier choice and the shared Monte Carlo model
+        :param stratified: [False] allocate draws evenly to suppliers instead of in proportion to market share
+        :param metrics: [None] a RunMetrics in which to time the 'choose' and 'draw' phases of each iteration and
+         count 'draws'
+        :param schedule: [None] a fixed sequence of supplier indices to draw, in order, instead of choosing them.
+         Parallel workers use this to draw their share of a stratified allocation planned by the parent.
+        """
+        self._metrics = RunMetrics() if metrics is None else metrics
+        self._schedule = None if schedule is None else iter(schedule)
         mkt_flow = market.get('flow')
         demand_base = {x.input: x.amount for x in market.technosphere() if x.get('flow') != mkt_flow}
         suppliers = [(x.amount, x.input) for x in market.technosphere() if x.get('flow') == mkt_flow]
         mkt_shares = [x[0] for x in suppliers]
-        self._chooser = WeightedChooser(mkt_shares)
         self._suppliers = [x[1] for x in suppliers]
-        self._mca = []
+        self._demand_base = demand_base
 
-        self._biosphere_dict = None
-        self._inventory = None
-        self._choices = []
+        chooser_seed, mc_seed = self._split_seed(seed)
+        self._weighted = WeightedChooser(mkt_shares, seed=chooser_seed)
+        self._stratified = StratifiedChooser(mkt_shares)
+        self._chooser = self._stratified if stratified else self._weighted
 
+        demand = dict(demand_base)
         for x in self._suppliers:
-            demand = dict(demand_base)
             demand[x] = 1.0
-            self._mca.append(MonteCarloLCA(demand, method=None))
+        self._mc = MonteCarloLCA(demand, method=None, seed=mc_seed)
+        self._demands = dict()  # supplier index -> demand array
+        self._guesses = dict()  # supplier index -> warm start for the iterative solver
+
+        self._inventory = None
+        self._choices = ScoreArray(dtype=choice_dtype(len(self._suppliers)))
+
+    @staticmethod
+    def _split_seed(seed):
+        """
+        :param seed:
+        :return: a seed for the supplier choice and a seed for the Monte Carlo model
+        """
+        if seed is None:
+            return None, None
+        ss = np.random.SeedSequence(seed)
+        return ss.spawn(1)[0], int(ss.generate_state(1)[0] >> 1)
+
+    def reseed(self, seed):
+        """
+        Restart the supplier choice and the Monte Carlo model from a new seed.  This only takes effect before the
+        first draw: once the model's generators have been built, their streams simply continue.
+        :param seed:
+        :return: True if the iterator was reseeded
+        """
+        if hasattr(self._mc, 'tech_rng'):
+            return False
+        chooser_seed, mc_seed = self._split_seed(seed)
+        self._weighted._rng = np.random.default_rng(chooser_seed)
+        self._mc.seed = mc_seed
+        return True
+
+    def _load_lci(self):
+        """
+        The model's matrices and indices, without its random number generators, which are only created (from the
+        current seed) by the first draw
+        """
+        if not hasattr(self._mc, 'tech_params'):
+            self._mc.load_lci_data()
+        return self._mc
+
+    def _load(self):
+        if not hasattr(self._mc, 'tech_rng'):
+            self._mc.load_data()
+        return self._mc
+
+    def _demand_array(self, r):
+        if r not in self._demands:
+            demand = dict(self._demand_base)
+            demand[self._suppliers[r]] = 1.0
+            m = self._load_lci()
+            m.build_demand_array(demand)
+            self._demands[r] = m.demand_array
+        return self._demands[r]
 
     @property
     def biosphere(self):
-        if self._biosphere_dict is None:
-            next(self)
-        return self._biosphere_dict
+        return self._load_lci()._biosphere_dict
 
     @property
     def inventory(self):
@@ -64,42 +262,115 @@ class MarketMonteCarloIterator(object):
 
     @property
     def market_shares(self):
-        return self._chooser.list
+        return self._weighted.list
+
+    @property
+    def stratified(self):
+        return self._chooser is self._stratified
+
+    @stratified.setter
+    def stratified(self, value):
+        self._chooser = self._stratified if value else self._weighted
 
     @property
     def suppliers(self):
         return self._suppliers
 
+    @property
+    def choice_dtype(self):
+        return self._choices.dtype
+
     @property
     def last_index(self):
-        return self._choices[-1]
+        return int(self.choices[-1])
 
     @property
     def choices(self):
-        for x in self._choices:
-            yield x
+        """
+        :return: the supplier index of every draw so far, as a read-only array view
+        """
+        if 'choices' not in self._choices:
+            return np.zeros(0, dtype=self.choice_dtype)
+        view = self._choices['choices']
+        view.flags.writeable = False
+        return view
+
+    def _extend_choices(self, choices):
+        """
+        Add draws made elsewhere (by a worker process, or in an earlier session) to the choice record
+        :param choices:
+        :return:
+        """
+        choices = np.asarray(choices, dtype=self.choice_dtype)
+        self._choices.extend('choices', choices)
+        self._stratified.restore_counts(choices)
 
     def __iter__(self):
         return self
 
+    @property
+    def metrics(self):
+        return self._metrics
+
     def __next__(self):
-        r = next(self._chooser)
-        self._choices.append(r)
-        m = self._mca[r]
-        next(m)
-        if self._biosphere_dict is None:
-            self._biosphere_dict = m._biosphere_dict  # assuming this is going to be the same for all
-        self._inventory = m.inventory
+        with self._metrics.phase('choose'):
+            r = next(self._chooser) if self._schedule is None else int(next(self._schedule))
+            self._choices.extend('choices', (r,))
+        with self._metrics.phase('draw'):  # parameter sampling, rebuild and solve all happen inside MonteCarloLCA
+            m = self._load()
+            m.demand_array = self._demand_array(r)
+            m.guess = self._guesses.get(r)
+            next(m)
+            self._guesses[r] = m.guess
+            self._inventory = m.inventory
+        self._metrics.count('draws')
         return r
 
 
 class Bw2McaMarketWeight(Bw2McaContainer):
+    """
+    Monte Carlo results for a market process, where each draw is an inventory of one supplier chosen at random in
+    proportion to its market share.
 
+    With stratified=True, draws are instead allocated evenly to all suppliers with a nonzero share, and the
+    market-weighted distribution is recovered by weighting each draw with weights(method).  Minor suppliers are then
+    sampled as well as dominant ones, so the mixture is resolved with far fewer draws.
+
+    The supplier chosen for each sample is kept alongside the scores, in a compact integer array per method, and is
+    saved with them, so the sample can be extended incrementally in either mode and the scores can be broken down by
+    supplier (supplier_scores) without re-simulating.
+    """
     FILE_PREFIX = 'BW2_MktWt'
 
-    def __init__(self, market, *args, **kwargs):
-        self._sol = MarketMonteCarloIterator(market)
-        super(Bw2McaMarketWeight, self).__init__(market, *args, **kwargs)
+    @classmethod
+    def _import_json(cls, store, j):
+        store.import_json(j, stratified=bool(j.get('stratified', False)))  # files from older versions are weighted
+        if 'choices' in j:
+            choices = McaResultStore(os.path.join(store.path, 'choices'), dtype=j['choice_dtype'])
+            for k, v in j['choices'].items():
+                choices.append(k, v)
+            choices.commit(j['database'], int(j['steps']), j['method_map'])
+
+    def __init__(self, market, *args, seed=None, stratified=None, metrics=None, _schedule=None, **kwargs):
+        """
+
+        :param market:
+        :param args:
+        :param seed:
+        :param stratified: [None] allocate draws evenly to suppliers.  None uses the mode the stored results were
+         generated with, or False for new results.
+        :param metrics: [None] a RunMetrics, shared with the MarketMonteCarloIterator
+        :param _schedule: [None] supplier indices to draw, for a parallel worker (see MarketMonteCarloIterator)
+        :param kwargs:
+        """
+        if metrics is None:
+            metrics = RunMetrics()
+        self._stratified_arg = stratified
+        self._sol = MarketMonteCarloIterator(market, seed=seed, stratified=bool(stratified), metrics=metrics,
+                                             schedule=_schedule)
+        self._choice_res = ScoreArray(dtype=self._sol.choice_dtype)
+        self._choice_store = None
+        super(Bw2McaMarketWeight, self).__init__(market, *args, seed=seed, metrics=metrics, **kwargs)
 
     @property
     def suppliers(self):
@@ -109,10 +380,13 @@ class Bw2McaMarketWeight(Bw2McaContainer):
     def market_shares(self):
         return self._sol.market_shares
 
+    @property
+    def stratified(self):
+        return self._sol.stratified
+
     @property
     def choices(self):
-        for x in self._sol.choices:
-            yield x
+        return self._sol.choices
 
     @property
     def biosphere(self):
@@ -121,10 +395,149 @@ class Bw2McaMarketWeight(Bw2McaContainer):
     def _next_inventory(self):
         return self._sol.inventory
 
+    @property
+    def _unknown(self):
+        """
+        Choice record for samples that predate it
+        """
+        return np.iinfo(self._choice_res.dtype).max
+
+    @property
+    def _choices_path(self):
+        return os.path.join(self.store_path, 'choices')
+
+    def _install_store(self, steps):
+        super(Bw2McaMarketWeight, self)._install_store(steps)
+        stored = self._store.meta.get('stratified', False)
+        if self._stratified_arg is None:
+            self._sol.stratified = stored
+        elif bool(self._stratified_arg) != stored and self._store.meta['steps'] > 0:
+            self._metrics.report('mode', 'Warning: %d stored draws are %s; new draws will be %s' % (
+                self._store.meta['steps'], _mode(stored), _mode(self._stratified_arg)),
+                stored=stored, stratified=bool(self._stratified_arg))
+        self._choice_store = McaResultStore(self._choices_path, dtype=self._sol.choice_dtype)
+        longest = None
+        for k in self._res.keys():
+            n = self._res.count(k)
+            c = self._choice_store.load(k)[:n]  # choices may run ahead of scores if a write was interrupted
+            self._choice_store.truncate(k, len(c))
+            if len(c) < n:
+                # results that predate the choice record can't be attributed to a supplier
+                self._choice_res.extend(k, np.full(n - len(c), self._unknown))
+            self._choice_res.extend(k, c)
+            if longest is None or n > self._res.count(longest):
+                longest = k
+        if longest is not None:
+            c = self._choice_res[longest]
+            self._sol._extend_choices(c[c != self._unknown])
+
+    def _append_block(self, block):
+        """
+        The draws in a block are the last len(block) choices made by the iterator
+        """
+        choices = self._sol.choices[-len(block):]
+        for key in self._keys:
+            short = self.steps - self._res.count(key)
+            if short > 0:
+                self._choice_res.extend(key, choices[:short])
+        return super(Bw2McaMarketWeight, self)._append_block(block)
+
+    def _write_file(self):
+        """
+        The choice record is committed before the scores, so that every committed score has a committed choice
+        """
+        if self._choice_store is None:
+            self._choice_store = McaResultStore(self._choices_path, dtype=self._sol.choice_dtype)
+        nbytes = 0
+        with self._metrics.phase('write'):
+            for k in self._choice_res.keys():
+                nbytes += self._choice_store.append(k, self._choice_res[k][self._choice_store.length(k):])
+            self._choice_store.commit(self.database, self.steps, self._m_map)
+        self._metrics.count('bytes_written', nbytes)
+        super(Bw2McaMarketWeight, self)._write_file()
+
+    def _store_meta(self):
+        meta = super(Bw2McaMarketWeight, self)._store_meta()
+        meta['stratified'] = self.stratified
+        return meta
+
+    def _serialize(self):
+        j = super(Bw2McaMarketWeight, self)._serialize()
+        j['stratified'] = self.stratified
+        j['choice_dtype'] = self._choice_res.dtype.str
+        j['choices'] = {k: self._choice_res[k].tolist() for k in self._choice_res.keys()}
+        return j
+
+    def _reseed(self, seed):
+        self._sol.reseed(seed)
+
+    def _worker_kwargs(self, sizes):
+        """
+        A stratified allocation only balances if it is planned as a whole: the parent plans the next sum(sizes) draws
+        from its current counts and gives each worker its consecutive share, so the merged draws match a serial run.
+        """
+        if not self.stratified:
+            return [{'stratified': False} for _ in sizes]
+        plan = self._sol._stratified.plan(sum(sizes))
+        bounds = np.cumsum([0] + list(sizes))
+        return [{'stratified': True, '_schedule': plan[a:b].tolist()} for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def _worker_state(self):
+        return np.array(self._sol.choices)
+
+    def _merge_worker_state(self, state):
+        self._sol._extend_choices(state)
+
+    def _choice_record(self, method):
+        key = next(k for k, v in self._m_map.items() if v == method)
+        if key not in self._choice_res:
+            return np.zeros(0, dtype=self._choice_res.dtype)
+        return self._choice_res[key]
+
+    def supplier_counts(self, method):
+        """
+        :param method:
+        :return: the number of samples of the method drawn from each supplier, in the order of self.suppliers
+        """
+        c = self._choice_record(method)
+        return np.bincount(c[c != self._unknown], minlength=len(self.suppliers))
+
+    def supplier_scores(self, method):
+        """
+        The method's scores, conditional on the supplier.  The scores are grouped by supplier once, with a stable
+        sort, and each supplier's scores are a slice of the grouped array.
+        :param method:
+        :return: a list of read-only arrays, one per supplier in the order of self.suppliers, each in draw order
+        """
+        c = self._choice_record(method)
+        order = np.argsort(c, kind='stable')
+        grouped = np.array(self.scores(method))[order]
+        grouped.flags.writeable = False
+        bounds = np.searchsorted(c[order], np.arange(len(self.suppliers) + 1))
+        return [grouped[bounds[i]:bounds[i + 1]] for i in range(len(self.suppliers))]
+
+    def weights(self, method):
+        """
+        Sample weights that reproduce the market-weighted mixture: each sample drawn from supplier i is weighted by
+        share[i] / count[i].  This applies in either mode; for unstratified results it corrects for the random
+        deviation of the supplier counts from the market shares.  Suppliers that have not been sampled are left out,
+        and the weights of the rest are renormalized.  Samples that predate the choice record get zero weight.
+        :param method:
+        :return: float array, aligned with scores(method), summing to 1
+        """
+        c = self._choice_record(method)
+        known = c != self._unknown
+        if not known.any():
+            raise ValueError('No supplier record for %s' % (method,))
+        counts = np.bincount(c[known], minlength=len(self.suppliers))
+        shares = np.asarray(self.market_shares, dtype=float)
+        per_draw = np.zeros(len(shares))
+        per_draw[counts > 0] = shares[counts > 0] / counts[counts > 0]
+        w = np.zeros(len(c))
+        w[known] = per_draw[c[known]]
+        return w / w.sum()
+
 
-def initialize_market_model(db_name, activity_id, *args, steps=100):
-    try:
-        act = next(a for a in Database(db_name) if a.get('activity').startswith(activity_id))
-    except StopIteration:
-        raise ValueError('Activity not found: %s'% activity_id)
-    return Bw2McaMarketWeight(act, *args, steps=steps)
+def initialize_market_model(db_name, activity_id, *args, steps=100, **kwargs):
+    act = find_activity(db_name, activity_id, prefix=True, metrics=kwargs.get('metrics'))
+    return Bw2McaMarketWeight(act, *args, steps=steps, **kwargs)
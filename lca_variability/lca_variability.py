@@ -1,20 +1,102 @@
+import os
 import json
+import time
+import multiprocessing
+
+from collections import namedtuple
+
+from .background import BackgroundLcia
+from .market_table import MarketScoreTable
+from .metrics import RunMetrics
+
+
+_sweep_state = None  # (query, bg, quantities, lci kwargs, cache), set before forking and inherited by workers
+
+
+def _sweep_lci_cache():
+    bg = _sweep_state[1]
+    if isinstance(bg, BackgroundLcia):
+        return bg.lci_cache
+
+
+def _sweep_init():
+    """
+    Pool initializer: detach the LCI cache inherited from the parent, so the worker leaves the parent's spill files
+    alone and keeps its new LCIs to return
+    """
+    bg = _sweep_state[1]
+    if isinstance(bg, BackgroundLcia):
+        bg._metrics = RunMetrics()  # the worker's timings are returned with each market, not kept
+    lci_cache = _sweep_lci_cache()
+    if lci_cache is not None:
+        lci_cache.detach()
+
+
+def _sweep_worker(ext_ref):
+    """
+    Runs in a forked worker process: scores one market and its suppliers against the background inherited from the
+    parent, including any LU factorization the parent had already computed.
+    :param ext_ref: market external_ref
+    :return: a 4-tuple: ext_ref, list of ((quantity ref, process ref), score), list of (key, LCI vector) computed for
+     the market, to be merged into the parent's LCI cache, and the RunMetrics of the background for the market (or
+     None)
+    """
+    query, bg, quantities, kwargs, cache = _sweep_state
+    res = MarketImpactRangeResult(query.get(ext_ref), *quantities, cache=cache)
+    metrics = None
+    if isinstance(bg, BackgroundLcia):
+        metrics = bg.metrics
+        metrics.reset()  # holds only this market's unfolded timings, so it is cheap to send back
+    res.add_scores(bg, **kwargs)
+    lci_cache = _sweep_lci_cache()
+    return ext_ref, list(res._scores.items()), [] if lci_cache is None else lci_cache.take_new(), metrics
+
+
+_StoredSupplier = namedtuple('_StoredSupplier', ('termination', 'value'))  # a supplier exchange, from a checkpoint
 
 
 class MarketImpactRangeResult(object):
     """
     An object which computes and stores the LCIA results for market suppliers.
     """
-    def __init__(self, market, *quantities, index=None, saved_scores=None):
+    @classmethod
+    def from_checkpoint(cls, query, entry, *quantities, cache=None):
+        """
+        Rebuild a result from a checkpoint entry (see checkpoint_entry()) without querying the catalog.  The market
+        process itself is only retrieved from the query if the market property is used.
+        :param query: catalog query that can retrieve the market
+        :param entry: dict
+        :param quantities:
+        :param cache: [None] shared score cache
+        :return:
+        """
+        res = cls.__new__(cls)
+        res._index = entry['index']
+        res._cache = cache
+        res._query = query
+        res._market = None
+        res._market_ref = entry['market_external_ref']
+        res._flowref = entry['flow_ref']
+        res._quantities = quantities
+        res._suppliers = tuple(_StoredSupplier(t, v) for t, v in entry['suppliers'])
+        res._scores = {(q, p): v for q, d in entry['scores'].items() for p, v in d.items()}
+        return res
+
+    def __init__(self, market, *quantities, index=None, saved_scores=None, cache=None):
         """
         Note: use index=None to create a free-standing
         :param market: A process reference for a market process, supporting inventory queries
         :param quantities:
         :param index: [None] may only be set once
         :param saved_scores: [None] to restore scores from JSON
+        :param cache: [None] a dict of (process ref, flow ref, quantity ref) to score, shared among results.  Scores
+         found in the cache are not recomputed, and newly computed scores are added to it.
         """
         self._index = index
+        self._cache = cache
+        self._query = None
         self._market = market
+        self._market_ref = market.external_ref
         self._flowref = market.reference().flow.external_ref
         self._quantities = quantities
         self._suppliers = tuple([t for t in market.inventory(self._flowref)
@@ -25,7 +107,7 @@ class MarketImpactRangeResult(object):
                 if _q.external_ref not in saved_scores:
                     continue
                 d = saved_scores[_q.external_ref]
-                for _t in self.suppliers:
+                for _t in [self._market_ref] + list(self.suppliers):
                     if _t not in d:
                         continue
                     key = (_q.external_ref, _t)
@@ -33,8 +115,23 @@ class MarketImpactRangeResult(object):
 
     @property
     def market(self):
+        if self._market is None:
+            self._market = self._query.get(self._market_ref)
         return self._market
 
+    @property
+    def market_ref(self):
+        return self._market_ref
+
+    @property
+    def name(self):
+        """
+        The market's name if the market has been retrieved, otherwise its external_ref.  Never queries the catalog.
+        """
+        if self._market is None:
+            return self._market_ref
+        return str(self._market)
+
     @property
     def index(self):
         return self._index
@@ -47,28 +144,92 @@ class MarketImpactRangeResult(object):
 
     @property
     def scored(self):
-        if len(self._scores) < len(self._quantities) * (1 + len(self._suppliers)):
-            return False
-        return True
+        """
+        True once every quantity has a score for the market and each of its suppliers.  Scores are keyed by process,
+        so a market that lists itself (or one supplier twice) among its suppliers has fewer of them than exchanges.
+        """
+        refs = {self._market_ref}.union(x.termination for x in self._suppliers)
+        return all((q.external_ref, ref) in self._scores for q in self._quantities for ref in refs)
+
+    def _from_cache(self, ext_ref):
+        if self._cache is None:
+            return
+        for qty in self._quantities:
+            key = (ext_ref, self._flowref, qty.external_ref)
+            if key in self._cache:
+                self._scores.setdefault((qty.external_ref, ext_ref), self._cache[key])
+
+    def update_cache(self, cache):
+        """
+        Add this result's scores to a shared score cache
+        :param cache: dict of (process ref, flow ref, quantity ref) to score
+        :return:
+        """
+        for (q, ext_ref), v in self._scores.items():
+            cache[ext_ref, self._flowref, q] = v
+
+    def _set_score(self, qty, ext_ref, value):
+        self._scores[qty.external_ref, ext_ref] = value
+        if self._cache is not None:
+            self._cache[ext_ref, self._flowref, qty.external_ref] = value
+
+    def add_quantity(self, quantity):
+        """
+        Register another quantity.  Its scores are computed by the next add_scores(), which only computes missing
+        (quantity, process) scores.
+        :param quantity:
+        :return:
+        """
+        if all(q.external_ref != quantity.external_ref for q in self._quantities):
+            self._quantities = tuple(self._quantities) + (quantity,)
+
+    def _scored(self, ext_ref):
+        self._from_cache(ext_ref)
+        return all((qty.external_ref, ext_ref) in self._scores for qty in self._quantities)
+
+    def _add_scores_batch(self, bg, ext_refs, **kwargs):
+        """
+        Score several processes with a single background solve
+        :param bg: a BackgroundLcia
+        :param ext_refs: process refs, all of which deliver the market's reference flow
+        :param kwargs: passed to bg.scores_matrix()
+        :return:
+        """
+        todo = []
+        for ext_ref in ext_refs:
+            if not self._scored(ext_ref) and ext_ref not in todo:
+                todo.append(ext_ref)
+        if len(todo) == 0:
+            return
+        res = bg.scores_matrix([(ext_ref, self._flowref) for ext_ref in todo], **kwargs)
+        for col, ext_ref in enumerate(todo):
+            for qty in self._quantities:
+                if (qty.external_ref, ext_ref) not in self._scores:
+                    self._set_score(qty, ext_ref, float(res[bg.index(qty), col]))
 
     def _add_scores_for_inventory(self, bg, ext_ref, **kwargs):
-        if all((qty.external_ref, ext_ref) in self._scores for qty in self._quantities):
+        if self._scored(ext_ref):
             return
         inv = [z for z in bg.lci(ext_ref, self._flowref, **kwargs)]
         for qty in self._quantities:
             if (qty.external_ref, ext_ref) in self._scores:
                 continue
             res = qty.do_lcia(inv)
-            self._scores[qty.external_ref, ext_ref] = res.total()
+            self._set_score(qty, ext_ref, res.total())
 
     def add_scores(self, bg, **kwargs):
         """
 
-        :param bg: an interface supporting background queries (e.g. lci())
+        :param bg: an interface supporting background queries (e.g. lci()), or a BackgroundLcia, which computes the
+         inventories of the market and all its suppliers in one solve and scores them with a single matrix product
         :param kwargs: passed to lci()
         :return:
         """
-        self._add_scores_for_inventory(bg, self._market.external_ref, **kwargs)
+        if isinstance(bg, BackgroundLcia):
+            self._add_scores_batch(bg, [self._market_ref] + [x.termination for x in self._suppliers],
+                                   **kwargs)
+            return
+        self._add_scores_for_inventory(bg, self._market_ref, **kwargs)
         for x in self._suppliers:
             self._add_scores_for_inventory(bg, x.termination, **kwargs)
 
@@ -78,7 +239,7 @@ class MarketImpactRangeResult(object):
 
     @property
     def market_scores(self):
-        return [self._scores[quantity.external_ref, self._market.external_ref] for quantity in self.quantities]
+        return [self._scores[quantity.external_ref, self._market_ref] for quantity in self.quantities]
 
     @property
     def suppliers(self):
@@ -104,11 +265,15 @@ class MarketImpactRangeResult(object):
         :return:
         """
         if market:
+            dropped = list(self._scores.keys())
             self._scores = dict()  # complete reset
         else:
-            for x in self.suppliers:
-                for q in self.quantities:
-                    self._scores.pop((q.external_ref, x))
+            dropped = [(q.external_ref, x) for x in self.suppliers for q in self.quantities]
+            for k in dropped:
+                self._scores.pop(k)
+        if self._cache is not None:
+            for q, ext_ref in dropped:
+                self._cache.pop((ext_ref, self._flowref, q), None)
 
     def scores(self, quantity):
         return [x for x in self._res_by_quantity(quantity)]
@@ -147,32 +312,92 @@ class MarketImpactRangeResult(object):
     def serialize(self):
         return {
             'index': self.index,
-            'market_external_ref': self.market.external_ref,
+            'market_external_ref': self._market_ref,
             'scores': self._serialize_scores()
         }
 
+    def checkpoint_entry(self):
+        """
+        serialize() plus what is needed to use the result without the catalog: the reference flow and the
+        supplier exchanges
+        :return:
+        """
+        j = self.serialize()
+        j['flow_ref'] = self._flowref
+        j['suppliers'] = [[x.termination, x.value] for x in self._suppliers]
+        return j
+
 
 class MarketIterator(object):
     """
 
     """
     @classmethod
-    def restore(cls, filename, catalog):
+    def restore(cls, filename, catalog, **kwargs):
+        """
+        :param filename: a file written by save(), or a checkpoint (*.jsonl, see resume())
+        :param catalog:
+        :param kwargs: passed to __init__, e.g. background, lu_cache, markets, workers
+        :return:
+        """
+        if filename.endswith('.jsonl'):
+            return cls.resume(filename, catalog, **kwargs)
         with open(filename, 'r') as fp:
             j = json.load(fp)
         quantities = [catalog.query(q['origin']).get(q['external_ref']) for q in j['quantities']]
         factorize = j.pop('lu_factorization', False)
-        mi = cls(catalog.query(j['origin']), *quantities, lu_factorization=factorize)
+        mi = cls(catalog.query(j['origin']), *quantities, lu_factorization=factorize, **kwargs)
+        for p, f, q, v in j.get('score_cache', []):  # written by older versions
+            mi._cache[p, f, q] = v
         for r in j['results']:
             idx = r['index']
             assert idx == len(mi)
             res = MarketImpactRangeResult(catalog.query(j['origin']).get(r['market_external_ref']), *quantities,
                                           index=idx,
-                                          saved_scores=r['scores'])
+                                          saved_scores=r['scores'],
+                                          cache=mi._cache)
+            res.update_cache(mi._cache)
             mi._res_add(res)
         return mi
 
-    def __init__(self, query, *quantities, lu_factorization=True):
+    @classmethod
+    def resume(cls, filename, catalog, **kwargs):
+        """
+        Restore from a checkpoint file (see checkpoint()) and keep appending to it.  Results are read line by line
+        and rebuilt without querying the catalog; a line left incomplete by an interrupted write is discarded.
+        :param filename:
+        :param catalog:
+        :param kwargs: passed to __init__
+        :return:
+        """
+        with open(filename, 'rb') as fp:
+            j = json.loads(fp.readline().decode('utf-8'))
+            quantities = [catalog.query(q['origin']).get(q['external_ref']) for q in j['quantities']]
+            query = catalog.query(j['origin'])
+            mi = cls(query, *quantities, lu_factorization=j['lu_factorization'], **kwargs)
+            good = fp.tell()
+            for line in fp:
+                try:
+                    r = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                assert r['index'] == len(mi)
+                res = MarketImpactRangeResult.from_checkpoint(query, r, *quantities, cache=mi._cache)
+                res.update_cache(mi._cache)
+                mi._res_add(res)
+                good += len(line)
+        if good < os.path.getsize(filename):
+            mi.metrics.report('checkpoint', 'Discarding incomplete checkpoint entry', filename=filename)
+            with open(filename, 'r+b') as fp:
+                fp.truncate(good)
+        mi._checkpoint = filename
+        mi._checkpointed = len(mi)
+        return mi
+
+    def __init__(self, query, *quantities, lu_factorization=True, workers=None, background=None, lu_cache=None,
+                 markets=None, lci_cache=None, metrics=None):
         """
 
         :param query: a catalog query with available background, index, and inventory implementations
@@ -180,19 +405,53 @@ class MarketIterator(object):
         :param lu_factorization: [True] Perform LU decomposition- costs about 30s first time through, in exchange for
         speeding up LCI computations by about 10x thereafter (30-40ms vs 300-400ms). This means it's worth it if you
         are going to do more than about 100 computations.
+        :param workers: [None] number of worker processes sweep() uses.  None or 1 computes markets one at a time.
+        :param background: [None] the query's background archive (catalog.get_archive(origin, 'background')).  If
+         given, scores are computed from the flat background's matrices by a BackgroundLcia instead of through lci()
+         and do_lcia().
+        :param lu_cache: [None] with background, a directory in which to keep the LU factorization, so that it is
+         computed once per background (keyed by origin and a checksum of the matrix) rather than once per session.
+        :param markets: [None] a MarketIndex (e.g. filtered or sharded) or a list of market external_refs to work
+         through, in order.  The default is every process whose name starts with 'market for', except electricity
+         markets, found by querying the catalog.
+        :param lci_cache: [None] with background, an LciCache of LCI vectors, which may be shared with other
+         iterators or with ad-hoc analysis.  LCIs held in the cache are reused instead of solved again.
+        :param metrics: [None] a RunMetrics to record the 'retrieve', 'score', 'checkpoint' and 'sweep' phases and
+         count 'markets' and 'bytes_written' (checkpoint), and to deliver progress messages.  With background, it is
+         shared with the BackgroundLcia, which splits scoring into its 'solve' and 'characterize' phases.
         """
+        self._metrics = RunMetrics() if metrics is None else metrics
         self._query = query
         self._factorize = lu_factorization
-        self._mkt_iterator = (mkt for mkt in self._query.processes(Name='^market for') if not
-                              mkt['Name'].startswith('market for electricity'))
+        self._workers = int(workers or 1)
+        if markets is None:
+            self._market_refs = None
+            self._mkt_iterator = (mkt for mkt in self._query.processes(Name='^market for') if not
+                                  mkt['Name'].startswith('market for electricity'))
+        else:
+            self._market_refs = iter(list(getattr(markets, 'refs', markets)))
+            self._mkt_iterator = (self._query.get(ref) for ref in self._market_refs if ref not in self._result_map)
         self._results = []
         self._result_map = dict()
         self._quantities = quantities
+        self._cache = dict()  # (process ref, flow ref, quantity ref) -> score, shared by all results
+        if background is None:
+            self._lcia = None
+        else:
+            self._lcia = BackgroundLcia(background, query, *quantities, lu_cache=lu_cache, lci_cache=lci_cache,
+                                        metrics=self._metrics)
+        self._checkpoint = None
+        self._checkpointed = 0  # number of results written to the checkpoint
+        self._table = None
 
     @property
     def origin(self):
         return self._query.origin
 
+    @property
+    def metrics(self):
+        return self._metrics
+
     @property
     def results(self):
         for k in self._results:
@@ -205,28 +464,187 @@ class MarketIterator(object):
         if res.index is None:
             res.index = l
         assert self._results[res.index] is res
-        self._result_map[res.market.external_ref] = res
+        self._result_map[res.market_ref] = res
+
+    def checkpoint(self, filename):
+        """
+        Write results to an append-only checkpoint file (JSON Lines: a header line, then one line per market) as
+        each market is completed.  Results so far are written immediately.  A sweep that is interrupted can be
+        picked up again with MarketIterator.resume(filename, catalog).
+        The file is written in full under a temporary name and then moved into place, so that rewriting an existing
+        checkpoint (e.g. after add_quantity()) never leaves it truncated.
+        :param filename: conventionally *.jsonl, so that restore() recognizes it
+        :return:
+        """
+        previous = self._checkpoint, self._checkpointed
+        tmp = filename + '.tmp'
+        self._checkpoint = tmp
+        self._checkpointed = 0
+        try:
+            with open(tmp, 'w') as fp:
+                json.dump(self._header(), fp)
+                fp.write('\n')
+            self._write_checkpoint()
+            os.replace(tmp, filename)
+        except BaseException:
+            self._checkpoint, self._checkpointed = previous
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._checkpoint = filename
+
+    def _write_checkpoint(self):
+        if self._checkpoint is None:
+            return
+        nbytes = 0
+        with self._metrics.phase('checkpoint'), open(self._checkpoint, 'a') as fp:
+            while self._checkpointed < len(self._results) and self._results[self._checkpointed].scored:
+                line = json.dumps(self._results[self._checkpointed].checkpoint_entry()) + '\n'
+                fp.write(line)
+                nbytes += len(line)  # json.dumps escapes non-ASCII, so characters are bytes
+                self._checkpointed += 1
+        self._metrics.count('bytes_written', nbytes)
 
     def _res_gen(self, ext_ref=None):
-        if ext_ref is None:
-            mkt = next(self._mkt_iterator)
-            if mkt.external_ref in self._result_map:
-                return self._result_map[mkt.external_ref]
-        else:
-            # check result_map to avoid running the query if possible
-            if ext_ref in self._result_map:
-                return self._result_map[ext_ref]
-            mkt = self._query.get(ext_ref)
-        res = MarketImpactRangeResult(mkt, *self._quantities, index=len(self._results))
+        with self._metrics.phase('retrieve'):
+            if ext_ref is None:
+                mkt = next(self._mkt_iterator)
+                if mkt.external_ref in self._result_map:
+                    return self._result_map[mkt.external_ref]
+            else:
+                # check result_map to avoid running the query if possible
+                if ext_ref in self._result_map:
+                    return self._result_map[ext_ref]
+                mkt = self._query.get(ext_ref)
+            res = MarketImpactRangeResult(mkt, *self._quantities, index=len(self._results), cache=self._cache)
         self._res_add(res)
         self._res_populate(res)
+        self._metrics.count('markets')
+        self._write_checkpoint()
         return res
 
-    def _res_populate(self, res):
+    @property
+    def _lci_kwargs(self):
         if self._factorize:
-            res.add_scores(self._query, solver='factorize')  # this takes about 30s the first time through
-        else:
-            res.add_scores(self._query)
+            return {'solver': 'factorize'}
+        return dict()
+
+    @property
+    def _bg(self):
+        if self._lcia is None:
+            return self._query
+        return self._lcia
+
+    def _res_populate(self, res):
+        with self._metrics.phase('score'):
+            res.add_scores(self._bg, **self._lci_kwargs)  # with factorize, this takes about 30s the first time through
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @workers.setter
+    def workers(self, value):
+        self._workers = int(value or 1)
+
+    def sweep(self, limit=None, workers=None):
+        """
+        Work through the remaining markets, computing up to limit of them concurrently on a pool of worker processes.
+
+        One market is computed in this process first, so that the background (and its LU factorization) is loaded
+        before the pool is forked; the workers then share it rather than each building their own.  Markets are
+        dispatched in iteration order and their results are added in that order, so each market receives the same
+        index it would have received from next(), and serialize() / restore() are unaffected.  LCIs solved by the
+        workers are added to the LCI cache as their markets come back.
+
+        Requires the 'fork' start method (i.e. not Windows); otherwise, or with one worker, markets are computed here.
+        :param limit: [None] maximum number of markets to compute (default: all remaining)
+        :param workers: [None] default is self.workers
+        :return: the number of markets added
+        """
+        workers = int(workers or self._workers)
+        tstart = time.time()
+        base = (self._metrics.total('solve'), self._metrics.total('characterize'))
+        count = 0
+        if limit is not None and limit <= 0:
+            return count
+        while count == 0:
+            n = len(self._results)
+            try:
+                next(self)  # warms up the background
+            except StopIteration:
+                return count
+            count = len(self._results) - n
+
+        with self._metrics.phase('sweep'):
+            return self._sweep(count, tstart, base, limit, workers)
+
+    def _sweep(self, count, tstart, base, limit, workers):
+        """
+        The rest of sweep(), once the background is warm
+        """
+        global _sweep_state
+        pending = []
+        while limit is None or count + len(pending) < limit:
+            try:
+                if self._market_refs is None:
+                    ref = next(self._mkt_iterator).external_ref
+                else:
+                    ref = next(self._market_refs)  # no need to retrieve the market in this process
+            except StopIteration:
+                break
+            if ref not in self._result_map and ref not in pending:
+                pending.append(ref)
+
+        if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            for ext_ref in pending:
+                self.get_result(ext_ref)
+            count += len(pending)
+            self._report_complete(count, tstart, base, 1)
+            return count
+
+        if self._lcia is not None:
+            _ = self._lcia.characterization  # built once, before forking
+        _sweep_state = (self._query, self._bg, self._quantities, self._lci_kwargs, self._cache)
+        try:
+            with multiprocessing.get_context('fork').Pool(workers, initializer=_sweep_init) as pool:
+                for ext_ref, scores, lcis, metrics in pool.imap(_sweep_worker, pending, chunksize=4):
+                    for key, vector in lcis:
+                        self._lcia.lci_cache.put(key, vector)
+                    if metrics is not None:
+                        self._metrics.merge(metrics)
+                    res = MarketImpactRangeResult(self._query.get(ext_ref), *self._quantities,
+                                                  index=len(self._results), cache=self._cache)
+                    res._scores.update(scores)
+                    res.update_cache(self._cache)
+                    self._res_add(res)
+                    self._metrics.count('markets')
+                    self._write_checkpoint()
+                    count += 1
+                    if count % 100 == 0:
+                        elapsed = time.time() - tstart
+                        self._metrics.report('progress', 'Completed %d markets in %d workers (%.3f sec)' % (
+                            count, workers, elapsed), markets=count, workers=workers, elapsed=elapsed,
+                            rate=count / elapsed)
+        finally:
+            _sweep_state = None
+        self._report_complete(count, tstart, base, workers)
+        return count
+
+    def _report_complete(self, count, tstart, base, workers):
+        """
+        With a BackgroundLcia, the message splits the time the sweep spent scoring into solving and characterizing
+        (summed over the workers, if there were several)
+        :param base: the 'solve' and 'characterize' totals when the sweep started
+        """
+        elapsed = time.time() - tstart
+        solve = self._metrics.total('solve') - base[0]
+        characterize = self._metrics.total('characterize') - base[1]
+        message = 'Added %d markets (%.3f sec)' % (count, elapsed)
+        if self._lcia is not None:
+            message += '; solve %.3f sec, characterize %.3f sec' % (solve, characterize)
+        self._metrics.report('complete', message, markets=count, workers=workers, elapsed=elapsed, solve=solve,
+                             characterize=characterize)
 
     def __iter__(self):
         return self
@@ -253,12 +671,50 @@ class MarketIterator(object):
     def markets(self):
         return [res.market for res in self._results]
 
+    def add_quantity(self, quantity):
+        """
+        Register another quantity on a live or restored iterator and score it for every existing result.  Existing
+        scores are kept; only the missing (quantity, process) scores are computed, and processes shared among
+        markets are computed once.
+        :param quantity:
+        :return:
+        """
+        if any(q.external_ref == quantity.external_ref for q in self._quantities):
+            return
+        self._quantities = tuple(self._quantities) + (quantity,)
+        if self._lcia is not None:
+            self._lcia.add_quantity(quantity)
+        for res in self._results:
+            res.add_quantity(quantity)
+        self._table = None
+        tstart = time.time()
+        for i, res in enumerate(self._results):
+            self._res_populate(res)
+            if (i + 1) % 100 == 0:
+                elapsed = time.time() - tstart
+                self._metrics.report('progress', 'Scored %d markets for %s (%.3f sec)' % (
+                    i + 1, quantity.external_ref, elapsed), markets=i + 1, quantity=quantity.external_ref,
+                    elapsed=elapsed)
+        if self._checkpoint is not None:
+            self.checkpoint(self._checkpoint)  # rewritten, since the header and every entry have changed
+
+    def table(self, refresh=False):
+        """
+        The supplier scores of all markets as a columnar MarketScoreTable, for vectorized statistics.  The table is
+        kept until more markets are added; use refresh=True after changing scores of existing results.
+        :param refresh: [False]
+        :return:
+        """
+        if refresh or self._table is None or self._table.shape[0] != len(self._results):
+            self._table = MarketScoreTable.from_results(self._results, self._quantities)
+        return self._table
+
     @property
     def ratios(self):
-        return [res.max_ratio[0] for res in self._results]
+        return self.table().max_ratios()[0].tolist()
 
     def ratios_for_quantity(self, quantity):
-        return [res.ratio(quantity) for res in self._results]
+        return self.table().ratios_for_quantity(quantity).tolist()
 
     def __getitem__(self, item):
         return self._results[item]
@@ -266,14 +722,20 @@ class MarketIterator(object):
     def __len__(self):
         return len(self._results)
 
-    def serialize(self):
+    def _header(self):
         return {
             'origin': self._query.origin,
             'quantities': [{'origin': q.origin, 'external_ref': q.external_ref} for q in self._quantities],
-            'results': [r.serialize() for r in self._results],
             'lu_factorization': self._factorize
         }
 
+    def serialize(self):
+        j = self._header()
+        j['results'] = [r.serialize() for r in self._results]
+        # the score cache is not written: each result's scores include the market's own, so restore() rebuilds the
+        # cache-- including the scores of markets that supply other markets-- from the results
+        return j
+
     def save(self, filename):
         with open(filename, 'w') as fp:
             json.dump(self.serialize(), fp, indent=2)
@@ -0,0 +1,171 @@
+"""
+Memory-bounded cache of LCI vectors.
+
+LCIs are kept as dense vectors over a background's emission index (see BackgroundLcia.lci_matrix), by default in
+float32 to halve their footprint.  The in-memory tier holds vectors up to a byte budget and evicts the least recently
+used; evicted vectors are either dropped or, if a spill directory is given, written there as .npy files and
+memory-mapped when they are next needed.  Spilled files belong to the cache that wrote them and are removed with it.
+
+A cache inherited by a forked worker process must be detached (see LciCache.detach()) before it is used there, so that
+the worker leaves the parent's spill files alone and keeps the vectors it computes for the parent to merge.
+"""
+
+import os
+import hashlib
+import tempfile
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LciCache(object):
+    """
+    A least-recently-used map of (process ref, flow ref) to LCI vector, with a memory budget and an optional
+    on-disk spill tier.  A single cache can be shared by several MarketIterators and by ad-hoc analysis.
+    """
+    def __init__(self, budget=256 * 1024 ** 2, dtype='f4', spill=None, spill_budget=None):
+        """
+
+        :param budget: [256 MiB] maximum bytes held in memory
+        :param dtype: ['f4'] storage type of the vectors
+        :param spill: [None] directory for vectors evicted from memory, or True for a temporary directory.  If None,
+         evicted vectors are discarded.
+        :param spill_budget: [None] maximum bytes held on disk (default: unlimited)
+        """
+        self._budget = int(budget)
+        self._dtype = np.dtype(dtype)
+        self._own_spill = spill is True
+        if spill is True:
+            spill = tempfile.mkdtemp(prefix='lci_cache_')
+        self._spill = spill
+        self._spill_budget = spill_budget
+        self._mem = OrderedDict()  # key -> array
+        self._disk = OrderedDict()  # key -> (filename, nbytes)
+        self._nbytes = 0
+        self._disk_nbytes = 0
+        self._detached = False
+        self._new = None  # key -> vector added since detach(), to hand back to the parent
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    @property
+    def disk_nbytes(self):
+        return self._disk_nbytes
+
+    def __len__(self):
+        return len(self._mem) + len(self._disk)
+
+    def __contains__(self, key):
+        return key in self._mem or key in self._disk
+
+    def _spill_file(self, key):
+        return os.path.join(self._spill, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npy')
+
+    def _drop_from_disk(self, key):
+        fn, nbytes = self._disk.pop(key)
+        self._disk_nbytes -= nbytes
+        if self._detached:
+            return  # the file belongs to the parent
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+
+    def _to_disk(self, key, arr):
+        if self._spill is None:
+            return
+        if self._spill_budget is not None and arr.nbytes > self._spill_budget:
+            return
+        os.makedirs(self._spill, exist_ok=True)
+        fn = self._spill_file(key)
+        np.save(fn, arr)
+        self._disk[key] = (fn, arr.nbytes)
+        self._disk_nbytes += arr.nbytes
+        while self._spill_budget is not None and self._disk_nbytes > self._spill_budget:
+            self._drop_from_disk(next(iter(self._disk)))
+
+    def _evict(self):
+        while self._nbytes > self._budget and len(self._mem) > 0:
+            key, arr = self._mem.popitem(last=False)
+            self._nbytes -= arr.nbytes
+            self._to_disk(key, arr)
+
+    def get(self, key):
+        """
+        :param key: (process ref, flow ref)
+        :return: the cached vector (read-only; memory-mapped if it was spilled to disk), or None
+        """
+        if key in self._mem:
+            self._mem.move_to_end(key)
+            self.hits += 1
+            return self._mem[key]
+        if key in self._disk:
+            self._disk.move_to_end(key)
+            self.hits += 1
+            return np.load(self._disk[key][0], mmap_mode='r')
+        self.misses += 1
+        return None
+
+    def put(self, key, vector):
+        """
+        :param key: (process ref, flow ref)
+        :param vector: the LCI, as a 1d array over the emission index
+        :return:
+        """
+        if key in self._mem:
+            self._nbytes -= self._mem.pop(key).nbytes
+        if key in self._disk:
+            self._drop_from_disk(key)
+        arr = np.array(vector, dtype=self._dtype).ravel()
+        arr.flags.writeable = False
+        if self._new is not None:
+            self._new[key] = arr
+        if arr.nbytes > self._budget:
+            self._to_disk(key, arr)
+            return
+        self._mem[key] = arr
+        self._nbytes += arr.nbytes
+        self._evict()
+
+    def detach(self):
+        """
+        Make this copy of the cache, inherited by a forked worker process, independent of the parent's.  Vectors the
+        parent had spilled can still be read, but the copy never writes or removes spill files; evicted vectors are
+        discarded instead.  Vectors put() from now on are also kept aside until take_new() hands them back.
+        :return:
+        """
+        self._detached = True
+        self._spill = None
+        self._own_spill = False
+        self._new = OrderedDict()
+
+    def take_new(self):
+        """
+        :return: a list of (key, vector) put() since detach() or the last call to take_new(), for the parent to put()
+         into its own cache
+        """
+        if self._new is None:
+            return []
+        new = list(self._new.items())
+        self._new = OrderedDict()
+        return new
+
+    def clear(self):
+        for key in list(self._disk.keys()):
+            self._drop_from_disk(key)
+        self._mem = OrderedDict()
+        self._nbytes = 0
+
+    def __del__(self):
+        if getattr(self, '_disk', None):
+            self.clear()
+        if getattr(self, '_own_spill', False):
+            try:
+                os.rmdir(self._spill)
+            except OSError:
+                pass
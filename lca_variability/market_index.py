@@ -0,0 +1,140 @@
+"""
+Persistent index of the market processes in a catalog origin.
+
+Finding the markets means walking the whole process list with a name query, and counting a market's suppliers means
+loading its inventory.  MarketIndex does this once and saves, for each market, its external_ref, name, geography,
+reference flow and number of suppliers to a JSON file.  Sweeps can then select markets on those fields, and split
+them deterministically among workers, without touching the catalog.
+"""
+
+import os
+import re
+import json
+import zlib
+
+from .metrics import RunMetrics
+
+
+class MarketIndex(object):
+    """
+    An ordered list of market records.  Filtering and sharding return new MarketIndex objects and keep the order.
+    """
+    FIELDS = ('external_ref', 'name', 'geography', 'flow_ref', 'suppliers')
+
+    @classmethod
+    def build(cls, query, name='^market for', metrics=None):
+        """
+        Walk the query's processes and record every market
+        :param query: a catalog query with index and inventory implementations
+        :param name: ['^market for'] name pattern passed to processes()
+        :param metrics: [None] a RunMetrics to deliver progress messages and count 'markets_indexed'
+        :return:
+        """
+        if metrics is None:
+            metrics = RunMetrics()
+        rows = []
+        for mkt in query.processes(Name=name):
+            flow_ref = mkt.reference().flow.external_ref
+            n = len([t for t in mkt.inventory(flow_ref) if t.flow.external_ref == flow_ref])
+            try:
+                geog = mkt['SpatialScope']
+            except KeyError:
+                geog = None
+            rows.append([mkt.external_ref, mkt['Name'], geog, flow_ref, n])
+            if len(rows) % 500 == 0:
+                metrics.report('progress', 'Indexed %d markets' % len(rows), markets=len(rows))
+        metrics.count('markets_indexed', len(rows))
+        return cls(query.origin, rows)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'r') as fp:
+            j = json.load(fp)
+        return cls(j['origin'], j['markets'])
+
+    @classmethod
+    def open(cls, query, filename, refresh=False, metrics=None):
+        """
+        Load the index from filename, or build and save it if the file does not exist, belongs to a different
+        origin, or refresh is True.  The catalog offers no modification stamp, so use refresh=True after the
+        database changes.
+        :param query:
+        :param filename:
+        :param refresh: [False]
+        :param metrics: [None] a RunMetrics to deliver progress messages (see build())
+        :return:
+        """
+        if not refresh and os.path.exists(filename):
+            idx = cls.load(filename)
+            if idx.origin == query.origin:
+                return idx
+        if metrics is None:
+            metrics = RunMetrics()
+        metrics.report('build_index', 'Building market index for %s' % query.origin, origin=query.origin)
+        idx = cls.build(query, metrics=metrics)
+        idx.save(filename)
+        return idx
+
+    def __init__(self, origin, rows):
+        self._origin = origin
+        self._rows = [tuple(r) for r in rows]
+
+    @property
+    def origin(self):
+        return self._origin
+
+    def save(self, filename):
+        with open(filename + '.tmp', 'w') as fp:
+            json.dump({'origin': self._origin, 'fields': list(self.FIELDS), 'markets': self._rows}, fp)
+        os.replace(filename + '.tmp', filename)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        for r in self._rows:
+            yield dict(zip(self.FIELDS, r))
+
+    @property
+    def refs(self):
+        return [r[0] for r in self._rows]
+
+    def filter(self, geography=None, min_suppliers=None, exclude=None, include=None):
+        """
+        :param geography: [None] a geography code or a collection of them to keep
+        :param min_suppliers: [None] keep markets with at least this many suppliers
+        :param exclude: [None] a regex or list of regexes; markets whose names match any are dropped
+        :param include: [None] a regex or list of regexes; only markets whose names match one are kept
+        :return: a new MarketIndex
+        """
+        if isinstance(geography, str):
+            geography = {geography}
+        if isinstance(exclude, str):
+            exclude = [exclude]
+        if isinstance(include, str):
+            include = [include]
+        ex = [re.compile(p) for p in exclude or ()]
+        inc = [re.compile(p) for p in include or ()]
+
+        def _keep(r):
+            if geography is not None and r[2] not in geography:
+                return False
+            if min_suppliers is not None and r[4] < min_suppliers:
+                return False
+            if any(p.search(r[1]) for p in ex):
+                return False
+            if inc and not any(p.search(r[1]) for p in inc):
+                return False
+            return True
+
+        return MarketIndex(self._origin, [r for r in self._rows if _keep(r)])
+
+    def shard(self, i, n):
+        """
+        Deterministically assign markets to one of n shards by a checksum of the external_ref, so that a market
+        lands in the same shard no matter how the index was filtered or ordered
+        :param i: shard number, 0 <= i < n
+        :param n: number of shards
+        :return: a new MarketIndex
+        """
+        return MarketIndex(self._origin, [r for r in self._rows if zlib.crc32(r[0].encode('utf-8')) % n == i])
@@ -0,0 +1,131 @@
+"""
+Columnar view of the supplier scores held by a MarketIterator.
+
+Each row of the table is one (market, supplier, quantity) score, stored in parallel NumPy arrays, so that statistics
+for every market and quantity are computed together in a single vectorized pass instead of one Python generator per
+market.  Scores that have not been computed are NaN and are left out of the statistics.
+"""
+
+import numpy as np
+
+
+class MarketScoreTable(object):
+    """
+    Columns: market (the result's index), supplier (position in the market's supplier list), quantity (position in
+    the iterator's quantity list), value (supplier exchange value) and score.  Statistics are returned as
+    (markets x quantities) arrays.
+    """
+    @classmethod
+    def from_results(cls, results, quantities):
+        """
+        :param results: MarketImpactRangeResults, in index order
+        :param quantities: quantity refs; their order fixes the quantity column
+        :return:
+        """
+        q_refs = [q.external_ref for q in quantities]
+        market, supplier, quantity, value, score = [], [], [], [], []
+        n = 0
+        for res in results:
+            for j, x in enumerate(res._suppliers):
+                for k, q in enumerate(q_refs):
+                    market.append(res.index)
+                    supplier.append(j)
+                    quantity.append(k)
+                    value.append(x.value)
+                    score.append(res._scores.get((q, x.termination), np.nan))
+            n += 1
+        return cls(np.array(market, dtype=np.int64), np.array(supplier, dtype=np.int64),
+                   np.array(quantity, dtype=np.int64), np.array(value, dtype=float), np.array(score, dtype=float),
+                   n, quantities)
+
+    def __init__(self, market, supplier, quantity, value, score, n_markets, quantities):
+        self.market = market
+        self.supplier = supplier
+        self.quantity = quantity
+        self.value = value
+        self.score = score
+        self._n = n_markets
+        self._quantities = list(quantities)
+        self._group = market * len(self._quantities) + quantity
+
+    @property
+    def quantities(self):
+        return list(self._quantities)
+
+    @property
+    def shape(self):
+        """
+        :return: (markets, quantities), the shape of the statistics arrays
+        """
+        return self._n, len(self._quantities)
+
+    def __len__(self):
+        return len(self.score)
+
+    def quantity_index(self, quantity):
+        return [q.external_ref for q in self._quantities].index(quantity.external_ref)
+
+    def _reshape(self, flat):
+        return flat.reshape(self.shape)
+
+    def ratios(self):
+        """
+        max |score| / min |score| among each market's nonzero supplier scores, or 0.0 if there are none, as in
+        MarketImpactRangeResult.ratio()
+        :return: (markets x quantities) array
+        """
+        size = self._n * len(self._quantities)
+        nz = ~np.isnan(self.score) & (self.score != 0)
+        g = self._group[nz]
+        a = np.abs(self.score[nz])
+        mx = np.full(size, -np.inf)
+        mn = np.full(size, np.inf)
+        np.maximum.at(mx, g, a)
+        np.minimum.at(mn, g, a)
+        has = np.bincount(g, minlength=size) > 0
+        r = np.zeros(size)
+        r[has] = mx[has] / mn[has]
+        return self._reshape(r)
+
+    def ratios_for_quantity(self, quantity):
+        return self.ratios()[:, self.quantity_index(quantity)]
+
+    def max_ratios(self):
+        """
+        The largest ratio for each market and the quantity that delivers it (the first, on ties), as in
+        MarketImpactRangeResult.max_ratio
+        :return: a 2-tuple: array of max ratios, array of quantity indices
+        """
+        r = self.ratios()
+        k = np.argmax(r, axis=1)
+        return r[np.arange(self._n), k], k
+
+    def unique(self):
+        """
+        The number of distinct supplier scores for each market and quantity
+        :return: (markets x quantities) int array
+        """
+        size = self._n * len(self._quantities)
+        ok = ~np.isnan(self.score)
+        g = self._group[ok]
+        s = self.score[ok]
+        o = np.lexsort((s, g))
+        g = g[o]
+        s = s[o]
+        first = np.ones(len(g), dtype=bool)
+        first[1:] = (g[1:] != g[:-1]) | (s[1:] != s[:-1])
+        return self._reshape(np.bincount(g[first], minlength=size))
+
+    def weighted_means(self):
+        """
+        The mean of each market's supplier scores, weighted by exchange value.  NaN where no scores are available or
+        the exchange values sum to zero.
+        :return: (markets x quantities) array
+        """
+        size = self._n * len(self._quantities)
+        ok = ~np.isnan(self.score)
+        g = self._group[ok]
+        num = np.bincount(g, weights=self.value[ok] * self.score[ok], minlength=size)
+        den = np.bincount(g, weights=self.value[ok], minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._reshape(np.where(den != 0, num / den, np.nan))
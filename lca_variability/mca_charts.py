@@ -3,7 +3,9 @@ Helper functions and utilities for plotting results
 """
 import numpy as np
 from math import floor, ceil
-from matplotlib import pyplot as plt
+from matplotlib.artist import setp
+
+from .mca_results import ScoreSketch
 
 
 class TraceLine(object):
@@ -31,27 +33,51 @@ Numerical processing functions
 '''
 
 def _find_range(ax, dat):
-    r1 = 1.2 * (max(dat) - min(dat))
+    r1 = 1.2 * np.ptp(np.asarray(dat, dtype=float))
     r2 = ax.get_xlim()[1] - ax.get_xlim()[0]
     return max([r1, r2])
 
 
+def nonzero_min(data):
+    """
+    :param data:
+    :return: the smallest positive value, or None if there is none
+    """
+    data = np.asarray(data)
+    _pos = data[data > 0]
+    if len(_pos) == 0:
+        return None
+    return _pos.min()
+
+
 def _kill_zeros(data, factor=10):
     _zero = data == 0
-    if sum(_zero) > 0:
-        low = next(k for k in sorted(data) if k > 0) / factor
+    _nz = np.count_nonzero(_zero)
+    if _nz > 0:
+        low = nonzero_min(data)
+        if low is None:
+            raise ValueError('No positive scores')
+        low = low / factor
         print('Warning: %d zero-valued scores found. Replacing with 1/%d the lowest nonzero value..' %
-              (sum(_zero), factor))
-        data[_zero] = low
+              (_nz, factor))
+        data = np.where(_zero, low, data)  # don't modify the caller's array, which may be a view of the results
     return data
 
 
-def find_95(_data):
+def find_95(_data, weights=None):
+    if isinstance(_data, ScoreSketch):
+        return _data.interval_95()
+    if weights is not None:
+        _o = np.argsort(_data)
+        _c = np.cumsum(np.asarray(weights, dtype=float)[_o])
+        _c /= _c[-1]
+        _s = np.asarray(_data)[_o]
+        return _s[np.searchsorted(_c, 0.025)], _s[min(np.searchsorted(_c, 0.975), len(_s) - 1)]
     _l = len(_data)
-    _s = sorted(_data)
-    _i025 = _s[int(ceil(_l * 0.025))]
-    _i975 = _s[int(floor(_l * 0.975))]
-    return _i025, _i975
+    _k025 = int(ceil(_l * 0.025))
+    _k975 = int(floor(_l * 0.975))
+    _s = np.partition(np.asarray(_data), [_k025, _k975])  # same order statistics as a full sort, in O(n)
+    return _s[_k025], _s[_k975]
 
 
 def is_outlier(points, thresh=3.5):
@@ -77,10 +103,11 @@ def is_outlier(points, thresh=3.5):
         Statistical Techniques, Edward F. Mykytka, Ph.D., Editor.
     """
     if len(points.shape) == 1:
-        points = points[:, None]
-    median = np.median(points, axis=0)
-    diff = np.sum((points - median) ** 2, axis=-1)
-    diff = np.sqrt(diff)
+        diff = np.abs(points - np.median(points))  # the 1-d case of the distance below, without the copies
+    else:
+        median = np.median(points, axis=0)
+        diff = np.sum((points - median) ** 2, axis=-1)
+        diff = np.sqrt(diff)
     med_abs_deviation = np.median(diff)
 
     modified_z_score = 0.6745 * diff / med_abs_deviation
@@ -88,56 +115,150 @@ def is_outlier(points, thresh=3.5):
     return modified_z_score > thresh
 
 
-def _add_mc_hist_to_ax(_ax, _data, bins=50, density=False, show_ci=False, log_correct=False, log_scale=True, **kwargs):
-    _npres = np.array(_data)
-    if log_scale:
-        _npres = _kill_zeros(_npres)
+class McStats(object):
+    """
+    The numbers behind a Monte Carlo histogram, computed once with vectorized operations: zeros replaced (on a log
+    scale), the MAD outlier mask, the trimmed sample with its weights, its range, 95% interval and bin edges.  Useful
+    on its own when only the numbers are wanted.
+    """
+    def __init__(self, data, weights=None, log_scale=True, thresh=6):
+        """
+
+        :param data: sample
+        :param weights: [None] per-sample weights (e.g. Bw2McaMarketWeight.weights()), rescaled over the trimmed
+         sample to sum to its length
+        :param log_scale: [True] replace zeros with a fraction of the smallest positive value (see _kill_zeros)
+        :param thresh: [6] modified z-score above which samples are outliers
+        """
+        self.n = len(data)
+        self.data = np.asarray(data, dtype=float)
+        if log_scale:
+            self.data = _kill_zeros(self.data)
+        self.outliers = is_outlier(self.data, thresh=thresh)
+        self.trimmed = self.data[~self.outliers]
+        if weights is None:
+            self.weights = None
+        else:
+            _w = np.asarray(weights, dtype=float)[~self.outliers]
+            self.weights = _w * len(_w) / _w.sum()
+        self.min = self.trimmed.min()
+        self.max = self.trimmed.max()
 
-    _trim = is_outlier(_npres, thresh=6)
-    _nptrim = _npres[~_trim]
-    if show_ci:
-        _tag = ' (w/95CI)'
+    @property
+    def interval_95(self):
+        return find_95(self.trimmed, weights=self.weights)
+
+    def bin_edges(self, bins=50, log_bins=False):
+        """
+        :param bins: [50] number of bins
+        :param log_bins: [False] logarithmically spaced bins (the lower edge is nudged down so the minimum is counted)
+        :return: bins + 1 edges spanning the trimmed sample
+        """
+        if log_bins:
+            return np.logspace(np.log10(self.min) - .001, np.log10(self.max), bins + 1)
+        return np.histogram_bin_edges(self.trimmed, bins=bins, range=(self.min, self.max))
+
+    def histogram(self, bins=50, log_bins=False, density=False):
+        """
+        :return: counts (weighted, if weights were given) and bin edges
+        """
+        return np.histogram(self.trimmed, bins=self.bin_edges(bins, log_bins=log_bins), weights=self.weights,
+                            density=density)
+
+
+class McHistogram(object):
+    """
+    A Monte Carlo histogram ready to be drawn: bin edges and counts, sample size, 95% interval and the trimmed
+    outliers.  It is computed from a sample (via McStats) or from a ScoreSketch, without reference to any axes, and is
+    small and picklable, so it can be computed once and drawn many times, or in another process (see batch_charts).
+    """
+    def __init__(self, data, bins=50, density=False, log_correct=False, log_scale=True, weights=None, **kwargs):
+        """
+
+        :param data: sample, or a ScoreSketch (see Bw2McaContainer.sketch()).  Sketches are drawn without trimming
+         outliers, since they do not keep the samples needed to find them, and are only resolved to about 4.7% (see
+         ScoreSketch.histogram()).
+        :param bins: [50] number of bins
+        :param density: [False] normalize the counts to a probability density (not with log_correct)
+        :param log_correct: [False] logarithmically spaced bins, with raw counts
+        :param log_scale: [True] draw on a log-scale x axis
+        :param weights: [None] per-sample weights, e.g. Bw2McaMarketWeight.weights() for stratified results.  They
+         are scaled so the histogram keeps the same total as an unweighted one.
+        :param kwargs: ignored
+        """
+        self.log_scale = log_scale
+        density = density and not log_correct
+        if isinstance(data, ScoreSketch):
+            self.n = data.n
+            if log_scale or log_correct:
+                _lo = data.min_positive
+                if _lo is None:
+                    raise ValueError('No positive scores')
+                self.edges = np.logspace(np.log10(_lo) - .001, np.log10(data.max), bins + 1)
+            else:
+                self.edges = np.linspace(data.min, data.max, bins + 1)
+            self.counts = data.histogram(self.edges).astype(float)
+            if density:
+                self.counts /= self.counts.sum() * np.diff(self.edges)
+            self.interval_95 = data.interval_95()
+            self.outliers = np.zeros(0)
+        else:
+            _st = McStats(data, weights=weights, log_scale=log_scale)
+            self.n = _st.n
+            self.counts, self.edges = _st.histogram(bins, log_bins=log_correct, density=density)
+            self.interval_95 = _st.interval_95
+            self.outliers = _st.data[_st.outliers]
+
+    def draw(self, _ax, show_ci=False):
+        """
+        :param _ax: a matplotlib Axes
+        :param show_ci: [False] mark the 95% interval; 'stem' for stems, anything else true for ticks
+        :return: counts, bin edges, outliers
+        """
+        _tag = ' (w/95CI)' if show_ci else ''
+        _mids = 0.5 * (self.edges[:-1] + self.edges[1:])
+        vv, bins, _ = _ax.hist(_mids, bins=self.edges, weights=self.counts, histtype='step', linestyle=':',
+                               linewidth=2, label='Monte Carlo N=%d%s' % (self.n, _tag))
+        if self.log_scale:
+            _ax.set_xscale('log')
+        if show_ci:
+            _show_ci(_ax, self.interval_95, show_ci)
+        return vv, bins, self.outliers
+
+
+def _show_ci(_ax, _bounds, show_ci):
+    _ylim = _ax.get_ylim()
+    _yval = 0.82 * _ylim[0] + 0.18 * _ylim[1]
+    if show_ci == 'stem':
+        _m, _s, _b = _ax.stem(_bounds, (_yval, _yval))
+        setp(_m, color=[0.7, 0, 0.4], marker='+', markersize=8, markeredgewidth=2)
+        setp(_b, visible=False)
+        setp(_s, color=[0.7, 0, 0.4])
     else:
-        _tag = ''
+        _ax.scatter(_bounds, (_yval, _yval), marker='|', s=600, c=[[0.7, 0, 0.4]])
 
-    if log_correct:
-        log_bins = np.logspace(np.log10(min(_nptrim)) - .001, np.log10(max(_nptrim)), bins + 1)
-        vv, bins, _ = plt.hist(_nptrim, bins=log_bins, axes=_ax, histtype='step', density=False,
-                               linestyle=':', linewidth=2,
-                               label='Monte Carlo N=%d%s' % (len(_data), _tag))
-    else:
-        vv, bins, _ = plt.hist(_nptrim, bins=bins, axes=_ax, histtype='step', density=density,
-                               linestyle=':', linewidth=2,
-                               label='Monte Carlo N=%d%s' % (len(_data), _tag))
-    if log_scale:
-        _ax.set_xscale('log')
-
-    if show_ci:
-        _bounds = find_95(_nptrim)
-        _ylim = _ax.get_ylim()
-        _yval = 0.82 * _ylim[0] + 0.18 * _ylim[1]
-        if show_ci == 'stem':
-            _m, _s, _b = plt.stem(_bounds, (_yval, _yval))
-            plt.setp(_m, color=[0.7, 0, 0.4], marker='+', markersize=8, markeredgewidth=2)
-            plt.setp(_b, visible=False)
-            plt.setp(_s, color=[0.7, 0, 0.4])
-        else:
-            plt.scatter(_bounds, (_yval, _yval), marker='|', s=600, c=[[0.7, 0, 0.4]])
 
-    return vv, bins, _npres[_trim]
+def _add_mc_hist_to_ax(_ax, _data, bins=50, density=False, show_ci=False, log_correct=False, log_scale=True,
+                       weights=None, **kwargs):
+    """
+    See McHistogram
+    """
+    _h = McHistogram(_data, bins=bins, density=density, log_correct=log_correct, log_scale=log_scale,
+                     weights=weights)
+    return _h.draw(_ax, show_ci=show_ci)
 
 
 def _add_discrete_bars_to_ax(_ax, _xv, _yv, _norm, _nbins=50, _color=(0.7, 0, 0), **kwargs):
     rang = _find_range(_ax, _xv)
     _wid = rang / _nbins
     # _wid = max(_yv) / _norm
-    plt.bar(_xv, [_k / _wid for _k in _yv], width=_wid, color=_color, axes=_ax, **kwargs)
+    _ax.bar(_xv, [_k / _wid for _k in _yv], width=_wid, color=_color, **kwargs)
 
 
 def _add_scaled_bars_to_ax(_ax, _xv, _yv, _scale, _nbins=50, _color=(0, 0.4, 0.3), **kwargs):
     rang = _find_range(_ax, _xv)
     _wid = rang / _nbins
-    plt.bar(_xv, [_i * _scale for _i in _yv], width=_wid, color=_color, axes=_ax, **kwargs)
+    _ax.bar(_xv, [_i * _scale for _i in _yv], width=_wid, color=_color, **kwargs)
 
 
 _marker_props = ('marker', 'markersize', 'markerfacecolor', 'markeredgecolor', 'markeredgewidth')
@@ -145,12 +266,12 @@ _stem_props = ('linewidth', 'linestyle')
 
 
 def _add_stem_plot_to_ax(_ax, _xv, _yv, _scale, _color=(0, 0.62, 0.08), label=None, **kwargs):
-    (mkrs, stems, baseline) = plt.stem(_xv, [_i * _scale for _i in _yv], label=label)
-    plt.setp(baseline, visible=False)
-    plt.setp(stems, color=_color, **{k: v for k, v in kwargs.items() if k in _stem_props})
+    (mkrs, stems, baseline) = _ax.stem(_xv, [_i * _scale for _i in _yv], label=label)
+    setp(baseline, visible=False)
+    setp(stems, color=_color, **{k: v for k, v in kwargs.items() if k in _stem_props})
     _mkr_set = {k: v for k, v in kwargs.items() if k in _marker_props}
     if len(_mkr_set) > 0:
-        plt.setp(mkrs, **_mkr_set)
+        setp(mkrs, **_mkr_set)
 
 
 '''
@@ -161,12 +282,17 @@ Public-facing functions
 def mc_mkt_combo(ax, xvals, shares, mc_res, annot, style='stem', traces=None, **kwargs):
     """
     valid styles: 'norm', 'stem', 'scaled'
+    mc_res is a sample, a ScoreSketch, or an McHistogram computed beforehand (with density=True for style 'norm'),
+    in which case only show_ci is used from kwargs.  Only the given axes are drawn on.
     """
     if style not in ('norm', 'stem', 'scaled'):
         raise ValueError('unknown style %s' % style)
 
     opt = style == 'norm'
-    vv, bins, trimmed = _add_mc_hist_to_ax(ax, mc_res, density=opt, **kwargs)
+    if isinstance(mc_res, McHistogram):
+        vv, bins, trimmed = mc_res.draw(ax, show_ci=kwargs.get('show_ci', False))
+    else:
+        vv, bins, trimmed = _add_mc_hist_to_ax(ax, mc_res, density=opt, **kwargs)
     if len(trimmed) > 0:
         print('%s: Trimmed %d outliers' % (annot['method'], len(trimmed)))
 
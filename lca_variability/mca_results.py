@@ -0,0 +1,492 @@
+"""
+Storage for Monte Carlo results.
+
+ScoreArray holds the scores in memory as a growable (methods x samples) float64 array, optionally backed by a
+memory-mapped file.
+
+McaResultStore keeps one append-only binary float64 file per LCIA method in a directory, plus a small JSON metadata
+file.  Saving new samples appends only those samples; loading memory-maps the files.  The metadata records how many
+samples of each method have been committed, so a write that is interrupted part-way is simply ignored on the next load.
+
+ScoreSketch summarizes a sample in fixed logarithmic bins with running moments, so that intervals and histograms of a
+growing result set can be had without reading the samples, and summaries of separate runs can be merged.
+"""
+
+import os
+import json
+import tempfile
+import warnings
+from math import ceil, floor
+
+import numpy as np
+
+
+class ScoreArray(object):
+    """
+    A growable 2d array with one row per key (LCIA method) and one column per sample.  Each row has its own length,
+    since methods added later have fewer samples.  Capacity grows geometrically, so extending is amortized O(1) per
+    sample; indexing by key returns a zero-copy view of that row's samples.
+    """
+    def __init__(self, dtype='f8', capacity=1024, filename=None):
+        """
+
+        :param dtype: ['f8'] element type
+        :param capacity: [1024] initial number of columns to allocate
+        :param filename: [None] back the array with a memory-mapped file of this name, or a temporary file if True.
+         The file is scratch space and is removed when the array is discarded; see McaResultStore for persistence.
+        """
+        self._dtype = np.dtype(dtype)
+        if filename is True:
+            fd, filename = tempfile.mkstemp(suffix='.scores')
+            os.close(fd)
+            os.remove(filename)  # only the unique name is needed; backing files are named <filename>.<generation>
+        self._filename = filename
+        self._gen = 0
+        self._rows = dict()
+        self._n = np.zeros(0, dtype=np.int64)
+        self._data = self._allocate(1, max(int(capacity), 1))
+
+    def _backing_file(self):
+        return '%s.%d' % (self._filename, self._gen)
+
+    def _allocate(self, rows, cols):
+        if self._filename is None:
+            return np.zeros((rows, cols), dtype=self._dtype)
+        self._gen += 1
+        return np.memmap(self._backing_file(), dtype=self._dtype, mode='w+', shape=(rows, cols))
+
+    def _release(self, old_file):
+        if old_file is not None:
+            try:
+                os.remove(old_file)
+            except OSError:
+                pass
+
+    def _resize(self, rows, cols):
+        old = self._data
+        old_file = self._backing_file() if self._filename is not None else None
+        new = self._allocate(rows, cols)
+        r, c = old.shape
+        new[:r, :c] = old
+        self._data = new
+        del old
+        self._release(old_file)
+
+    def __del__(self):
+        if getattr(self, '_filename', None) is not None:
+            self._data = None
+            self._release(self._backing_file())
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def capacity(self):
+        return self._data.shape[1]
+
+    @property
+    def nbytes(self):
+        return self._data.nbytes
+
+    def keys(self):
+        return list(self._rows.keys())
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add_key(self, key):
+        if key in self._rows:
+            return self._rows[key]
+        row = len(self._rows)
+        if row >= self._data.shape[0]:
+            self._resize(2 * self._data.shape[0], self.capacity)
+        self._rows[key] = row
+        self._n = np.append(self._n, 0)
+        return row
+
+    def count(self, key):
+        if key not in self._rows:
+            return 0
+        return int(self._n[self._rows[key]])
+
+    def reserve(self, cols):
+        """
+        Make room for at least cols samples per key
+        :param cols:
+        :return:
+        """
+        if cols > self.capacity:
+            self._resize(self._data.shape[0], max(int(cols), 2 * self.capacity))
+
+    def extend(self, key, values):
+        values = np.asarray(values, dtype=self._dtype).ravel()
+        row = self.add_key(key)
+        n = self._n[row]
+        self.reserve(n + len(values))
+        self._data[row, n:n + len(values)] = values
+        self._n[row] = n + len(values)
+
+    def __getitem__(self, key):
+        row = self._rows[key]
+        return self._data[row, :self._n[row]]
+
+
+class McaResultStore(object):
+    """
+    Append-only on-disk result store for a Bw2McaContainer.  The store is a directory holding:
+     - meta.json: database, steps, method map, and for each method key its data file and committed length
+     - one raw little-endian data file (float64 by default) per method, to which new samples are appended
+    """
+    META = 'meta.json'
+
+    def __init__(self, path, dtype='<f8'):
+        """
+
+        :param path: directory
+        :param dtype: ['<f8'] element type of the data files.  Once the store has been committed, the type recorded in
+         its metadata is used instead.
+        """
+        self._path = os.path.abspath(path)
+        self._dtype = np.dtype(dtype)
+        self._meta = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def exists(self):
+        return os.path.exists(os.path.join(self._path, self.META))
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            if self.exists:
+                with open(os.path.join(self._path, self.META), 'r') as fp:
+                    self._meta = json.load(fp)
+                if 'dtype' in self._meta:
+                    self._dtype = np.dtype(self._meta['dtype'])
+            else:
+                self._meta = {'database': None, 'steps': 0, 'method_map': dict(), 'files': dict(), 'lengths': dict()}
+        return self._meta
+
+    @property
+    def dtype(self):
+        _ = self.meta
+        return self._dtype
+
+    @property
+    def keys(self):
+        return list(self.meta['lengths'].keys())
+
+    def length(self, key):
+        return self.meta['lengths'].get(key, 0)
+
+    def _file(self, key):
+        files = self.meta['files']
+        if key not in files:
+            files[key] = 'r%03d.%s' % (len(files), self._dtype.str[1:])
+        return os.path.join(self._path, files[key])
+
+    def load(self, key, mmap=True):
+        """
+        Read the committed samples for a method
+        :param key:
+        :param mmap: [True] return a read-only memory map instead of reading the file into memory
+        :return: 1d array
+        """
+        n = self.length(key)
+        if n == 0:
+            return np.zeros(0, dtype=self._dtype)
+        if mmap:
+            return np.memmap(self._file(key), dtype=self._dtype, mode='r', shape=(n,))
+        return np.fromfile(self._file(key), dtype=self._dtype, count=n)
+
+    def append(self, key, values):
+        """
+        Append samples to a method's data file.  They are not committed until commit() is called.
+        :param key:
+        :param values:
+        :return: number of bytes written
+        """
+        arr = np.asarray(values, dtype=self.dtype)
+        if len(arr) == 0:
+            return 0
+        os.makedirs(self._path, exist_ok=True)
+        fn = self._file(key)
+        n = self.length(key)
+        with open(fn, 'ab') as fp:
+            fp.truncate(n * self._dtype.itemsize)  # discard any uncommitted tail from an interrupted write
+            fp.seek(n * self._dtype.itemsize)
+            fp.write(arr.tobytes())
+        self.meta['lengths'][key] = n + len(arr)
+        return arr.nbytes
+
+    def truncate(self, key, n):
+        """
+        Shorten a method's committed length to at most n samples.  Like append(), this takes effect at commit().
+        :param key:
+        :param n:
+        :return:
+        """
+        if self.length(key) > n:
+            self.meta['lengths'][key] = int(n)
+
+    def commit(self, database, steps, method_map, **kwargs):
+        """
+        Write the metadata, making appended samples visible to subsequent loads
+        :param database:
+        :param steps:
+        :param method_map: dict of key to method tuple
+        :param kwargs: additional JSON-serializable metadata to store
+        :return:
+        """
+        os.makedirs(self._path, exist_ok=True)
+        meta = self.meta
+        meta.update(kwargs)
+        meta['database'] = database
+        meta['dtype'] = self._dtype.str
+        meta['steps'] = steps
+        meta['method_map'] = {k: list(v) for k, v in method_map.items()}
+        for k in method_map.keys():
+            meta['lengths'].setdefault(k, 0)
+        fn = os.path.join(self._path, self.META)
+        with open(fn + '.tmp', 'w') as fp:
+            json.dump(meta, fp)
+        os.replace(fn + '.tmp', fn)
+
+    def import_json(self, j, **kwargs):
+        """
+        One-time import of a legacy serialized result set (as written by Bw2McaContainer.export_json)
+        :param j: dict with 'database', 'steps', 'method_map', 'results'
+        :param kwargs: additional metadata to store (see commit())
+        :return:
+        """
+        for k, v in j['results'].items():
+            self.append(k, v)
+        self.commit(j['database'], int(j['steps']), j['method_map'], **kwargs)
+
+    def serialize(self):
+        """
+        The whole result set in the legacy JSON layout, for interchange
+        :return:
+        """
+        meta = self.meta
+        return {'database': meta['database'],
+                'steps': meta['steps'],
+                'method_map': meta['method_map'],
+                'results': {k: self.load(k).tolist() for k in self.keys}
+                }
+
+
+class ScoreSketch(object):
+    """
+    A mergeable summary of a sample: counts in fixed log-spaced bins (BINS_PER_DECADE per decade from 1e-30 to 1e30,
+    separately for positive and negative values, plus a count of zeros) and running moments (count, mean, sum of
+    squared deviations, min, max).  Quantiles are located by bin and interpolated geometrically within it, so their
+    relative error is below 10 ** (1 / BINS_PER_DECADE) - 1 (under 5%).  Values beyond the bin range fall in the end
+    bins.  NaN and infinite values are counted in nonfinite and otherwise left out, so that they cannot poison the
+    moments.
+    """
+    BINS_PER_DECADE = 50
+    DECADES = (-30, 30)
+
+    @classmethod
+    def _nbins(cls):
+        return (cls.DECADES[1] - cls.DECADES[0]) * cls.BINS_PER_DECADE
+
+    @classmethod
+    def from_json(cls, j):
+        sk = cls()
+        sk.n = j['n']
+        sk.mean = j['mean']
+        sk.m2 = j['m2']
+        sk.min = j['min']
+        sk.max = j['max']
+        sk.zero = j['zero']
+        sk.nonfinite = j.get('nonfinite', 0)
+        for arr, d in ((sk._pos, j['pos']), (sk._neg, j['neg'])):
+            for k, v in d.items():
+                arr[int(k)] = v
+        return sk
+
+    def __init__(self, values=None):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.zero = 0
+        self.nonfinite = 0
+        self._pos = np.zeros(self._nbins(), dtype=np.int64)
+        self._neg = np.zeros(self._nbins(), dtype=np.int64)  # by magnitude
+        if values is not None:
+            self.update(values)
+
+    def _bin(self, magnitude):
+        b = np.floor((np.log10(magnitude) - self.DECADES[0]) * self.BINS_PER_DECADE)
+        return np.clip(b, 0, self._nbins() - 1).astype(np.int64)
+
+    def _edge(self, b):
+        return 10.0 ** (self.DECADES[0] + np.asarray(b, dtype=float) / self.BINS_PER_DECADE)
+
+    def _add_moments(self, n, mean, m2, lo, hi):
+        if n == 0:
+            return
+        tot = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / tot
+        self.m2 += m2 + delta ** 2 * self.n * n / tot
+        self.n = tot
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+
+    def update(self, values):
+        """
+        Add samples
+        :param values:
+        :return:
+        """
+        v = np.asarray(values, dtype=float).ravel()
+        finite = np.isfinite(v)
+        if not finite.all():
+            self.nonfinite += int(len(v) - np.count_nonzero(finite))
+            v = v[finite]
+        if len(v) == 0:
+            return
+        self._pos += np.bincount(self._bin(v[v > 0]), minlength=self._nbins())
+        self._neg += np.bincount(self._bin(-v[v < 0]), minlength=self._nbins())
+        self.zero += int(np.count_nonzero(v == 0))
+        mean = v.mean()
+        self._add_moments(len(v), mean, float(((v - mean) ** 2).sum()), float(v.min()), float(v.max()))
+
+    def merge(self, other):
+        """
+        Add the samples summarized by another sketch, e.g. one computed by a parallel worker
+        :param other: ScoreSketch
+        :return:
+        """
+        self._pos += other._pos
+        self._neg += other._neg
+        self.zero += other.zero
+        self.nonfinite += other.nonfinite
+        self._add_moments(other.n, other.mean, other.m2, other.min, other.max)
+
+    @property
+    def seen(self):
+        """
+        The number of values added, including the nonfinite ones left out of the summary
+        """
+        return self.n + self.nonfinite
+
+    @property
+    def min_positive(self):
+        """
+        The smallest positive sample, or the lower edge of its bin if there are also negative samples or zeros
+        """
+        if self.min is not None and self.min > 0:
+            return self.min
+        nz = np.flatnonzero(self._pos)
+        if len(nz) == 0:
+            return None
+        return float(self._edge(nz[0]))
+
+    @property
+    def var(self):
+        if self.n < 2:
+            return 0.0
+        return self.m2 / (self.n - 1)
+
+    @property
+    def std(self):
+        return self.var ** 0.5
+
+    def _ordered(self):
+        """
+        Bin counts and (low, high) bounds in ascending order of value: negative bins by decreasing magnitude, zeros,
+        then positive bins
+        """
+        b = np.arange(self._nbins())
+        counts = np.concatenate([self._neg[::-1], [self.zero], self._pos])
+        lo = np.concatenate([-self._edge(b + 1)[::-1], [0.0], self._edge(b)])
+        hi = np.concatenate([-self._edge(b)[::-1], [0.0], self._edge(b + 1)])
+        return counts, lo, hi
+
+    def order_statistic(self, k):
+        """
+        Approximate value of the k-th smallest sample (0-based)
+        :param k:
+        :return:
+        """
+        if not 0 <= k < self.n:
+            raise IndexError(k)
+        counts, lo, hi = self._ordered()
+        cum = np.cumsum(counts)
+        i = int(np.searchsorted(cum, k, side='right'))
+        frac = (k - (cum[i] - counts[i]) + 0.5) / counts[i]
+        if lo[i] == 0 and hi[i] == 0:
+            v = 0.0
+        elif lo[i] > 0:
+            v = lo[i] * (hi[i] / lo[i]) ** frac
+        else:
+            v = -(-hi[i] * (lo[i] / hi[i]) ** (1 - frac))
+        return min(max(v, self.min), self.max)
+
+    def quantile(self, q):
+        return self.order_statistic(min(int(floor(q * self.n)), self.n - 1))
+
+    def interval_95(self):
+        """
+        The same order statistics as mca_charts.find_95, approximately
+        :return:
+        """
+        return self.order_statistic(int(ceil(self.n * 0.025))), self.order_statistic(int(floor(self.n * 0.975)))
+
+    def histogram(self, edges):
+        """
+        Rebin the sketch.  Samples are assumed to be spread evenly in log space across each sketch bin (the outermost
+        bins are first narrowed to the observed min and max), so each bin's count is split among the histogram bins
+        it overlaps in proportion to the overlap in log space.  Zeros are counted in the bin that holds zero.
+
+        The sketch cannot resolve anything finer than one of its own bins, a factor of 10 ** (1 / BINS_PER_DECADE),
+        about 4.7%: histogram bins narrower than that only show the interpolation.  A warning is issued if any
+        histogram bin away from zero is narrower than a sketch bin.
+        :param edges: increasing bin edges
+        :return: counts, one per histogram bin
+        """
+        edges = np.asarray(edges, dtype=float)
+        a, b = edges[:-1], edges[1:]
+        same_sign = a * b > 0
+        if np.any(np.abs(np.log10(b[same_sign] / a[same_sign])) < 1.0 / self.BINS_PER_DECADE):
+            warnings.warn('Histogram bins are narrower than the sketch resolution (%.1f%%)' % (
+                100 * (10 ** (1.0 / self.BINS_PER_DECADE) - 1)))
+        counts, lo, hi = self._ordered()
+        nz = counts > 0
+        counts, lo, hi = counts[nz], np.maximum(lo[nz], self.min), np.minimum(hi[nz], self.max)
+        hi = np.maximum(hi, lo)
+        point = lo == hi  # the zero bin, or a bin narrowed to a single value
+
+        hist = np.zeros(len(a))
+        i = np.searchsorted(edges, lo[point], side='right') - 1
+        i[lo[point] == edges[-1]] = len(a) - 1
+        ok = (i >= 0) & (i < len(a))
+        hist += np.bincount(i[ok], weights=counts[point][ok], minlength=len(a))
+
+        counts, lo, hi = counts[~point], lo[~point], hi[~point]
+        u = np.maximum(lo[:, None], a[None, :])
+        v = np.minimum(hi[:, None], b[None, :])
+        inside = v > u
+        overlap = np.zeros(inside.shape)
+        overlap[inside] = np.abs(np.log(np.abs(v[inside]) / np.abs(u[inside])))
+        width = np.abs(np.log(np.abs(hi) / np.abs(lo)))
+        return hist + counts.dot(overlap / width[:, None])
+
+    def serialize(self):
+        return {'n': self.n, 'mean': self.mean, 'm2': self.m2, 'min': self.min, 'max': self.max, 'zero': self.zero,
+                'nonfinite': self.nonfinite,
+                'pos': {str(k): int(self._pos[k]) for k in np.flatnonzero(self._pos)},
+                'neg': {str(k): int(self._neg[k]) for k in np.flatnonzero(self._neg)}}
@@ -0,0 +1,167 @@
+"""
+Timers, counters and progress messages for long runs.
+
+Monte Carlo containers, MarketMonteCarloIterator and MarketIterator record the time spent in each phase of their
+work (e.g. parameter sampling, matrix rebuild, solve, scoring, file writing) and count what they produce (samples,
+markets, bytes written) in a RunMetrics object.  Phase times are kept as ScoreSketches, so the distribution of e.g.
+solve times is available at any point in a run of any length, and metrics from worker processes can be merged into
+the parent's.  Timings are buffered and folded into the sketches in batches, so that timing a phase costs a list
+append rather than a sketch update.
+
+Progress messages go through the same object.  By default they are printed, as before; with a callback, they are
+handed to the callback instead, along with their event name and fields, so a run can be monitored (or silenced)
+without editing the source.
+"""
+
+import time
+
+from contextlib import contextmanager
+
+import numpy as np
+
+from .mca_results import ScoreSketch
+
+
+class RunMetrics(object):
+    """
+    Phase timers and counters, and the channel for progress messages.  One RunMetrics can be shared by several
+    objects, e.g. a Bw2McaMarketWeight and its MarketMonteCarloIterator.
+    """
+    FOLD = 1024  # buffered timings per phase before they are folded into its sketch
+
+    def __init__(self, callback=None):
+        """
+
+        :param callback: [None] function(event, message, fields, metrics) called for each progress message instead
+         of printing it.  event is a short name (e.g. 'progress', 'complete', 'write'), fields a dict of the numbers
+         in the message.
+        """
+        self.callback = callback
+        self._phases = dict()  # phase -> ScoreSketch of durations in seconds
+        self._pending = dict()  # phase -> list of durations not yet folded into its sketch
+        self._counters = dict()
+        self._start = time.time()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['callback'] = None  # callbacks stay in the process that set them
+        return state
+
+    def reset(self):
+        self._phases = dict()
+        self._pending = dict()
+        self._counters = dict()
+        self._start = time.time()
+
+    @property
+    def elapsed(self):
+        """
+        Wall time since the metrics were created or reset
+        """
+        return time.time() - self._start
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the enclosed block as one occurrence of the phase
+        :param name:
+        :return:
+        """
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t)
+
+    def add_time(self, name, seconds):
+        """
+        Record one or more occurrences of a phase
+        :param name:
+        :param seconds: a duration, or an array of them
+        :return:
+        """
+        pending = self._pending.setdefault(name, [])
+        if isinstance(seconds, float) or np.ndim(seconds) == 0:
+            pending.append(seconds)
+        else:
+            pending.extend(np.ravel(seconds).tolist())
+        if len(pending) >= self.FOLD:
+            self._fold(name)
+
+    def _fold(self, name):
+        pending = self._pending.pop(name, None)
+        if pending:
+            self._phases.setdefault(name, ScoreSketch()).update(np.array(pending, dtype=float))
+
+    def count(self, name, n=1):
+        self._counters[name] = self._counters.get(name, 0) + n
+
+    def counter(self, name):
+        return self._counters.get(name, 0)
+
+    @property
+    def phases(self):
+        return sorted(set(self._phases.keys()).union(self._pending.keys()))
+
+    def timing(self, name):
+        """
+        :param name:
+        :return: a ScoreSketch of the phase's durations, e.g. timing('solve').quantile(0.95)
+        """
+        self._fold(name)
+        return self._phases.get(name, ScoreSketch())
+
+    def total(self, name):
+        sk = self.timing(name)
+        return sk.mean * sk.n if sk.n else 0.0
+
+    def rate(self, counter, phase=None):
+        """
+        :param counter: e.g. 'samples'
+        :param phase: [None] per second spent in this phase, or per second elapsed if None
+        :return:
+        """
+        t = self.elapsed if phase is None else self.total(phase)
+        if t <= 0:
+            return 0.0
+        return self.counter(counter) / t
+
+    def merge(self, other):
+        """
+        Add another RunMetrics' phase times and counters to these, e.g. from a worker process
+        :param other:
+        :return:
+        """
+        for k, sk in other._phases.items():
+            self._phases.setdefault(k, ScoreSketch()).merge(sk)
+        for k, v in other._pending.items():
+            self.add_time(k, v)
+        for k, v in other._counters.items():
+            self.count(k, v)
+
+    def report(self, event, message, **fields):
+        """
+        Deliver a progress message: to the callback, if there is one, or else print it
+        :param event: short event name
+        :param message: the formatted message
+        :param fields: the numbers in the message
+        :return:
+        """
+        if self.callback is None:
+            print(message)
+        else:
+            self.callback(event, message, fields, self)
+
+    def summary(self):
+        """
+        :return: a dict of elapsed time, counters, and count, total, mean, median, 95th percentile and maximum time
+         of each phase, in seconds
+        """
+        phases = dict()
+        for k in self.phases:
+            sk = self.timing(k)
+            if sk.n == 0:
+                continue
+            phases[k] = {'count': sk.n, 'total': float(sk.mean * sk.n), 'mean': float(sk.mean),
+                         'p50': sk.quantile(0.5), 'p95': sk.quantile(0.95), 'max': sk.max}
+        return {'elapsed': self.elapsed, 'counters': dict(self._counters), 'phases': phases}
@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from lca_variability import MarketImpactRangeResult, MarketIterator, RunMetrics
+
+
+class _Ref(object):
+    def __init__(self, external_ref):
+        self.external_ref = external_ref
+
+
+class _Exchange(object):
+    def __init__(self, flow, termination, value):
+        self.flow = flow
+        self.termination = termination
+        self.value = value
+
+
+class _Market(object):
+    def __init__(self, external_ref, flow, suppliers):
+        self.external_ref = external_ref
+        self._flow = flow
+        self._exchanges = [_Exchange(flow, t, v) for t, v in suppliers]
+
+    def reference(self):
+        return _Exchange(self._flow, None, 1.0)
+
+    def inventory(self, flowref):
+        return [x for x in self._exchanges if x.flow.external_ref == flowref]
+
+    def __str__(self):
+        return self.external_ref
+
+
+class _Result(object):
+    def __init__(self, value):
+        self._value = value
+
+    def total(self):
+        return self._value
+
+
+class _Quantity(_Ref):
+    origin = 'test'
+
+    def do_lcia(self, inv):
+        return _Result(float(sum(inv)))
+
+
+class _Query(object):
+    """
+    Markets and quantities by external_ref; the "LCI" of a process is the length of its name, so every score is
+    known.  The query is also its own catalog.
+    """
+    origin = 'test'
+
+    def __init__(self, *entities):
+        self._entities = {m.external_ref: m for m in entities}
+        self.solved = []
+
+    def query(self, origin):
+        return self
+
+    def get(self, ext_ref):
+        return self._entities[ext_ref]
+
+    def lci(self, ext_ref, flowref, **kwargs):
+        self.solved.append(ext_ref)
+        return [len(ext_ref)]
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'markets.jsonl')
+        flow = _Ref('product')
+        self.gwp = _Quantity('gwp')
+        self.query = _Query(self.gwp,
+                            _Market('mkt-a', flow, [('sup-1', 0.6), ('sup-2', 0.4)]),
+                            _Market('mkt-self', flow, [('mkt-self', 0.1), ('sup-1', 0.5), ('sup-3', 0.4)]),
+                            _Market('mkt-c', flow, [('sup-2', 1.0)]),
+                            _Market('mkt-d', flow, [('mkt-a', 0.7), ('sup-4', 0.3)]))
+        self.refs = ['mkt-a', 'mkt-self', 'mkt-c']
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    @staticmethod
+    def _metrics():
+        return RunMetrics(callback=lambda *args: None)
+
+    def _iterator(self):
+        return MarketIterator(self.query, self.gwp, lu_factorization=False, markets=self.refs, metrics=self._metrics())
+
+    def _checkpointed(self):
+        with open(self.filename) as fp:
+            return [json.loads(line)['market_external_ref'] for line in fp.readlines()[1:]]
+
+    def test_self_supplying_market(self):
+        mi = self._iterator()
+        mi.checkpoint(self.filename)
+        for _ in self.refs:
+            next(mi)
+        self.assertTrue(mi[1].scored)
+        self.assertEqual(self._checkpointed(), self.refs)
+
+    def test_sweep(self):
+        mi = self._iterator()
+        mi.checkpoint(self.filename)
+        mi.sweep()
+        self.assertEqual(self._checkpointed(), self.refs)
+
+    def test_restore_then_checkpoint(self):
+        mi = self._iterator()
+        mi.sweep()
+        saved = os.path.join(self.folder, 'markets.json')
+        mi.save(saved)
+        mi = MarketIterator.restore(saved, self.query, markets=self.refs, metrics=self._metrics())
+        self.assertTrue(all(res.scored for res in mi.results))
+        mi.checkpoint(self.filename)
+        self.assertEqual(self._checkpointed(), self.refs)
+
+    def test_interrupted_rewrite(self):
+        mi = self._iterator()
+        mi.checkpoint(self.filename)
+        mi.sweep()
+        with mock.patch.object(MarketImpactRangeResult, 'checkpoint_entry', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                mi.add_quantity(_Quantity('ch4'))  # rewrites the checkpoint
+        self.assertEqual(self._checkpointed(), self.refs)
+        self.assertEqual(os.listdir(self.folder), ['markets.jsonl'])
+        mi.checkpoint(self.filename)
+        with open(self.filename) as fp:
+            self.assertEqual(len(json.loads(fp.readline())['quantities']), 2)
+        self.assertEqual(self._checkpointed(), self.refs)
+
+    def test_restored_scores_are_reused(self):
+        mi = self._iterator()
+        mi.sweep()
+        saved = os.path.join(self.folder, 'markets.json')
+        mi.save(saved)
+        mi = MarketIterator.restore(saved, self.query, markets=self.refs, metrics=self._metrics())
+        self.query.solved = []
+        res = mi.get_result('mkt-d')  # supplied by mkt-a, whose score was saved with its own result
+        self.assertEqual(sorted(self.query.solved), ['mkt-d', 'sup-4'])
+        self.assertEqual(res.scores(self.gwp), [len('mkt-a'), len('sup-4')])
+
+
+if __name__ == '__main__':
+    unittest.main()
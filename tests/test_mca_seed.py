@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+import numpy as np
+from scipy import sparse
+
+from lca_variability import Bw2McaMarketWeight, RunMetrics
+from lca_variability import bw2_mca, bw2_mkt_weight
+
+
+N_BIO = 4
+
+
+class _MonteCarloLCA(object):
+    """
+    Enough of bw2calc's MonteCarloLCA for a MarketMonteCarloIterator: the generators are only created by
+    load_data(), from the seed set at that time, and each draw's inventory depends on the demand and the generator
+    """
+    def __init__(self, demand, method=None, seed=None):
+        self.demand = demand
+        self.seed = seed
+        self.guess = None
+
+    def load_lci_data(self):
+        self.tech_params = np.zeros(1)
+        self._biosphere_dict = {('biosphere', str(i)): i for i in range(N_BIO)}
+        self._product_dict = {k: i for i, k in enumerate(sorted(self.demand))}
+
+    def load_data(self):
+        self.load_lci_data()
+        self.tech_rng = np.random.default_rng(self.seed)
+
+    def build_demand_array(self, demand):
+        self.demand_array = np.zeros(len(self._product_dict))
+        for k, v in demand.items():
+            self.demand_array[self._product_dict[k]] = v
+
+    def __next__(self):
+        x = self.tech_rng.random(N_BIO) * (1 + np.arange(len(self.demand_array)).dot(self.demand_array))
+        self.inventory = sparse.csr_matrix(x.reshape(-1, 1))
+
+
+class _Exchange(object):
+    def __init__(self, input, amount, flow):
+        self.input = input
+        self.amount = amount
+        self._flow = flow
+
+    def get(self, key):
+        return self._flow if key == 'flow' else None
+
+
+class _Market(dict):
+    key = ('db', 'market')
+
+    def technosphere(self):
+        return [_Exchange(('db', 'sup-%d' % i), v, 'product') for i, v in enumerate((0.5, 0.3, 0.2))]
+
+
+def _c_matrix(self, method):
+    return sparse.diags(np.ones(len(self.biosphere)))
+
+
+@mock.patch.object(bw2_mkt_weight, 'MonteCarloLCA', _MonteCarloLCA)
+@mock.patch.object(Bw2McaMarketWeight, '_c_matrix', _c_matrix)
+class ReopenSeedTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.market = _Market(flow='product', database='db', activity='market-uuid')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    @staticmethod
+    def _metrics():
+        return RunMetrics(callback=lambda *args: None)
+
+    def _container(self, *methods, steps=None, **kwargs):
+        return Bw2McaMarketWeight(self.market, *methods, steps=steps, seed=1, folder=self.folder,
+                                  metrics=self._metrics(), **kwargs)
+
+    def test_top_up_after_reopen(self):
+        self._container(('m', 'a'), steps=50)
+        c = self._container()
+        c.steps = 100
+        scores = c.scores(('m', 'a'))
+        self.assertEqual(len(scores), 100)
+        self.assertFalse(np.array_equal(scores[:50], scores[50:]))
+        self.assertEqual(len(np.unique(scores)), 100)
+
+    def test_top_up_with_new_method(self):
+        c = self._container(('m', 'a'), steps=5)
+        c = self._container()
+        c.add_method(('m', 'b'), _suppress_update=True)
+        c.steps = 10
+        scores = c.scores(('m', 'a'))
+        self.assertEqual(len(np.unique(scores)), 10)
+
+
+    def test_stratified_json_round_trip(self):
+        c = self._container(('m', 'a'), steps=12, stratified=True)
+        os.makedirs(os.path.join(self.folder, 'export'))
+        filename = os.path.join(self.folder, 'export', c.filename)
+        c.export_json(filename)
+        with mock.patch.object(bw2_mca, 'find_activity', lambda *args, **kwargs: self.market):
+            d = Bw2McaMarketWeight.from_file(filename, metrics=self._metrics())
+        self.assertTrue(d.stratified)
+        d.steps = 15
+        self.assertEqual(np.bincount(d.choices).tolist(), [5, 5, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()